@@ -0,0 +1,82 @@
+# -*- coding: utf-8 -*-
+"""Zip code of each user's address, kept in memory for the delivery.check saga step."""
+import logging
+import os
+import time
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+ADDRESS_CACHE_SIZE = int(os.getenv("ADDRESS_CACHE_SIZE", "4096"))
+ADDRESS_CACHE_TTL = float(os.getenv("ADDRESS_CACHE_TTL", "300"))
+MISSING = object()  # Not cached (a cached None means the user has no address)
+
+
+class AddressCache:
+    """Bounded user_id -> zip code map with expiration.
+
+    Users without address are cached too (as None), so repeated checks for them do not
+    query either. create/update/delete_address invalidate their user; a zip code read
+    from the database before that invalidation is not stored. The last invalidation of
+    up to *max_size* * 4 users is remembered; older reads are not stored either.
+    """
+
+    def __init__(self, max_size: int = ADDRESS_CACHE_SIZE, ttl: float = ADDRESS_CACHE_TTL):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.__zip_codes = OrderedDict()  # user_id -> (expiration, zip_code)
+        self.__clock = 0
+        self.__invalidated_at = OrderedDict()  # user_id -> clock of its last invalidation
+        self.__forgotten_before = 0
+
+    @property
+    def generation(self) -> int:
+        """Current invalidation clock, to be passed to put() after reading the address."""
+        return self.__clock
+
+    def get(self, user_id):
+        """Zip code of the user (None if the user has no address), or MISSING if not cached."""
+        entry = self.__zip_codes.get(user_id)
+        if entry is None or entry[0] < time.monotonic():
+            if entry is not None:
+                del self.__zip_codes[user_id]
+            self.misses += 1
+            return MISSING
+        self.__zip_codes.move_to_end(user_id)
+        self.hits += 1
+        return entry[1]
+
+    def put(self, user_id, zip_code, generation: int):
+        """Caches the zip code read at *generation* unless the user's address changed since."""
+        if self.max_size <= 0 or generation < self.__invalidated_at.get(user_id, self.__forgotten_before):
+            return
+        self.__zip_codes[user_id] = (time.monotonic() + self.ttl, zip_code)
+        self.__zip_codes.move_to_end(user_id)
+        if len(self.__zip_codes) > self.max_size:
+            self.__zip_codes.popitem(last=False)
+
+    def invalidate(self, user_id):
+        """Forgets the user's zip code after an address write."""
+        self.__clock += 1
+        self.__zip_codes.pop(user_id, None)
+        self.__invalidated_at[user_id] = self.__clock
+        self.__invalidated_at.move_to_end(user_id)
+        while len(self.__invalidated_at) > max(self.max_size, 1) * 4:
+            _, self.__forgotten_before = self.__invalidated_at.popitem(last=False)
+
+    def stats(self):
+        """Size and hit counters of the cache."""
+        lookups = self.hits + self.misses
+        return {
+            "size": len(self.__zip_codes),
+            "max_size": self.max_size,
+            "ttl": self.ttl,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": self.hits / lookups if lookups else 0.0
+        }
+
+
+address_cache = AddressCache()
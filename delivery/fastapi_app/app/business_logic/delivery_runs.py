@@ -0,0 +1,77 @@
+# -*- coding: utf-8 -*-
+"""Delivery runs: produced orders of the same zone dispatched together."""
+import asyncio
+import logging
+import os
+
+from .timing_wheel import timer_wheel
+
+logger = logging.getLogger(__name__)
+
+DELIVERY_BATCHING = os.getenv("DELIVERY_BATCHING", "false").lower() == "true"
+DELIVERY_RUN_SIZE = int(os.getenv("DELIVERY_RUN_SIZE", "20"))
+DELIVERY_RUN_MAX_AGE = float(os.getenv("DELIVERY_RUN_MAX_AGE_MS", "2000")) / 1000
+
+
+class DeliveryRuns:
+    """Open runs per zone; a run starts when it has *run_size* orders or is *max_age* old.
+
+    The age limit is a timing wheel timer armed by the first order of the run.
+    *start_run(zone, order_ids)* persists and announces the run. add() waits for it,
+    so the produced message is acknowledged only once its dispatch is stored; if
+    start_run fails every waiting add() raises and the caller requeues its message.
+    """
+
+    def __init__(self, start_run, run_size: int = DELIVERY_RUN_SIZE, max_age: float = DELIVERY_RUN_MAX_AGE):
+        self.start_run = start_run
+        self.run_size = run_size
+        self.max_age = max_age
+        self.runs_started = 0
+        self.__runs = {}
+
+    async def add(self, zone, order_id):
+        """Puts the order in the open run of its zone; returns once that run has started."""
+        run = self.__runs.get(zone)
+        if run is None:
+            run = {"orders": [], "waiters": [], "timer": None}
+            self.__runs[zone] = run
+            run["timer"] = timer_wheel.schedule(self.max_age, self.__flush_if_current, zone, run)
+        run["orders"].append(order_id)
+        started = asyncio.get_running_loop().create_future()
+        run["waiters"].append(started)
+        if len(run["orders"]) >= self.run_size:
+            await self.flush(zone)
+        await started
+
+    async def flush(self, zone):
+        """Closes the open run of the zone and starts it."""
+        run = self.__runs.pop(zone, None)
+        if run is None:
+            return
+        run["timer"].cancel()
+        try:
+            await self.start_run(zone, run["orders"])
+            self.runs_started += 1
+        except Exception as exc:
+            logger.error("Could not start the run of %i orders in zone %s: %s", len(run["orders"]), zone, exc)
+            for waiter in run["waiters"]:
+                if not waiter.done():
+                    waiter.set_exception(exc)
+            return
+        for waiter in run["waiters"]:
+            if not waiter.done():
+                waiter.set_result(None)
+
+    def __flush_if_current(self, zone, run):
+        if self.__runs.get(zone) is run:
+            return self.flush(zone)  # Run as a task by the timing wheel
+        return None
+
+    def stats(self):
+        """Open runs (orders per zone) and number of runs started."""
+        return {
+            "run_size": self.run_size,
+            "max_age": self.max_age,
+            "pending": {str(zone): len(run["orders"]) for zone, run in self.__runs.items()},
+            "runs_started": self.runs_started
+        }
@@ -0,0 +1,172 @@
+# -*- coding: utf-8 -*-
+"""Persistent delivery dispatch scheduler with a bounded worker pool."""
+import asyncio
+import logging
+import os
+from datetime import datetime, timedelta
+
+from app.sql import crud
+from app.sql.database import SessionLocal
+from .timing_wheel import timer_wheel
+
+logger = logging.getLogger(__name__)
+
+DISPATCH_WORKERS = int(os.getenv("DISPATCH_WORKERS", "4"))
+DISPATCH_BATCH_SIZE = int(os.getenv("DISPATCH_BATCH_SIZE", "100"))
+DISPATCH_POLL_INTERVAL = float(os.getenv("DISPATCH_POLL_INTERVAL", "60"))
+DISPATCH_RETRY_DELAY = float(os.getenv("DISPATCH_RETRY_DELAY", "10"))
+DISPATCH_MAX_ATTEMPTS = int(os.getenv("DISPATCH_MAX_ATTEMPTS", "5"))
+
+
+class DeliveryScheduler:
+    """Dispatches the deliveries persisted in the delivery_dispatch table when they are due.
+
+    Due rows are read in batches ordered by scheduled_at and handed to a fixed pool of
+    workers through a bounded queue, so a burst of produced orders never creates more than
+    *workers* concurrent deliveries. Rows are deleted when delivered, so pending deliveries
+    are resumed after a restart.
+    *deliver* is a coroutine function called with a list of order ids: one order per call,
+    or, when *group* is given, up to *run_size* due orders with the same group(order_id).
+    Each pending delivery has a timer in the timing wheel that wakes the scheduler when it is
+    due; deliveries due in the same tick are read together. *poll_interval* is only a fallback.
+    A failed delivery is retried after *retry_delay* seconds, up to *max_attempts* attempts;
+    then its dispatch is dropped and the delivery marked failed.
+    """
+
+    def __init__(self, deliver, workers: int = DISPATCH_WORKERS, batch_size: int = DISPATCH_BATCH_SIZE,
+                 poll_interval: float = DISPATCH_POLL_INTERVAL, retry_delay: float = DISPATCH_RETRY_DELAY,
+                 max_attempts: int = DISPATCH_MAX_ATTEMPTS, group=None, run_size: int = 1):
+        self.deliver = deliver
+        self.group = group
+        self.run_size = run_size
+        self.workers = workers
+        self.batch_size = batch_size
+        self.poll_interval = poll_interval
+        self.retry_delay = retry_delay
+        self.max_attempts = max_attempts
+        self.dispatched = 0
+        self.failed = 0
+        self.given_up = 0
+        self.__queue = asyncio.Queue(maxsize=workers * 2)
+        self.__in_flight = set()
+        self.__timers = {}  # order_id -> timing wheel timer
+        self.__wakeup = asyncio.Event()
+
+    async def schedule(self, order_id: int, delay: float):
+        """Persists a delivery to be dispatched in *delay* seconds."""
+        await self.schedule_many([order_id], delay)
+
+    async def schedule_many(self, order_ids, delay: float):
+        """Persists several deliveries to be dispatched in *delay* seconds, in one transaction."""
+        scheduled_at = datetime.utcnow() + timedelta(seconds=delay)
+        async with SessionLocal() as db:
+            await crud.schedule_dispatches(db, order_ids, scheduled_at)
+        for order_id in order_ids:
+            self.__arm(order_id, delay)
+
+    def cancel(self, order_id: int):
+        """Cancels the timer of a pending delivery (its row is removed by the caller)."""
+        timer = self.__timers.pop(order_id, None)
+        if timer is not None:
+            timer.cancel()
+
+    def __arm(self, order_id: int, delay: float):
+        self.cancel(order_id)
+        self.__timers[order_id] = timer_wheel.schedule(delay, self.__on_due, order_id)
+
+    def __on_due(self, order_id: int):
+        self.__timers.pop(order_id, None)
+        self.__wakeup.set()
+
+    async def __arm_pending(self):
+        """Arms the timers of the deliveries persisted before a restart."""
+        now = datetime.utcnow()
+        async with SessionLocal() as db:
+            pending = await crud.get_pending_dispatches(db)
+        for order_id, scheduled_at in pending:
+            self.__arm(order_id, max(0.0, (scheduled_at - now).total_seconds()))
+        logger.info("%i pending deliveries resumed", len(pending))
+
+    async def run(self):
+        """Coroutine that reads due deliveries and feeds the workers."""
+        for _ in range(self.workers):
+            asyncio.create_task(self.__worker())
+        try:
+            await self.__arm_pending()
+        except Exception as exc:
+            logger.error("Error resuming pending deliveries: %s", exc)
+        while True:
+            # Cleared before reading, so timers that fire during the read or the puts are not lost
+            self.__wakeup.clear()
+            try:
+                order_ids = await self.__fetch_due()
+            except Exception as exc:
+                logger.error("Error reading due deliveries: %s", exc)
+                order_ids = []
+            for run in self.__runs(order_ids):
+                self.__in_flight.update(run)
+                await self.__queue.put(run)  # Blocks while the workers are busy
+            if len(order_ids) < self.batch_size:
+                await self.__wait(self.poll_interval)
+
+    def __runs(self, order_ids):
+        if self.group is None:
+            return [[order_id] for order_id in order_ids]
+        groups = {}
+        for order_id in order_ids:
+            groups.setdefault(self.group(order_id), []).append(order_id)
+        return [
+            run[start:start + self.run_size]
+            for run in groups.values()
+            for start in range(0, len(run), self.run_size)
+        ]
+
+    async def __fetch_due(self):
+        async with SessionLocal() as db:
+            return await crud.get_due_dispatches(db, datetime.utcnow(), self.batch_size, self.__in_flight)
+
+    async def __wait(self, timeout: float):
+        try:
+            await asyncio.wait_for(self.__wakeup.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+
+    async def __worker(self):
+        while True:
+            run = await self.__queue.get()
+            try:
+                await self.deliver(run)
+                self.dispatched += len(run)
+            except Exception as exc:
+                self.failed += len(run)
+                logger.error("Error dispatching deliveries %s: %s", run, exc)
+                try:
+                    await self.__retry(run)
+                except Exception as retry_exc:
+                    logger.error("Could not reschedule deliveries %s: %s", run, retry_exc)
+            finally:
+                self.__in_flight.difference_update(run)
+                self.__queue.task_done()
+
+    async def __retry(self, run):
+        scheduled_at = datetime.utcnow() + timedelta(seconds=self.retry_delay)
+        async with SessionLocal() as db:
+            given_up = set(await crud.retry_dispatches(db, run, scheduled_at, self.max_attempts))
+        if given_up:
+            self.given_up += len(given_up)
+            logger.error("Deliveries %s given up after %i attempts", sorted(given_up), self.max_attempts)
+        for order_id in run:
+            if order_id not in given_up:
+                self.__arm(order_id, self.retry_delay)
+
+    def stats(self):
+        """Return the scheduler counters as dict."""
+        return {
+            "workers": self.workers,
+            "queued": self.__queue.qsize(),
+            "in_flight": len(self.__in_flight),
+            "timers": len(self.__timers),
+            "dispatched": self.dispatched,
+            "failed": self.failed,
+            "given_up": self.given_up
+        }
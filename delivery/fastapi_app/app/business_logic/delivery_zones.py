@@ -0,0 +1,100 @@
+# -*- coding: utf-8 -*-
+"""Delivery zone rules, loaded from a data file into an in-memory lookup table."""
+import json
+import logging
+import os
+
+logger = logging.getLogger(__name__)
+
+DELIVERY_ZONES_FILE = os.getenv(
+    "DELIVERY_ZONES_FILE",
+    os.path.join(os.path.dirname(__file__), "delivery_zones.json")
+)
+PROVINCES = 100  # Spanish zip codes: the two first digits are the province (zip_code // 1000)
+
+
+class DeliveryZone:
+    """Zone served by the delivery service. *capacity* 0 means unlimited active deliveries."""
+
+    def __init__(self, name: str, capacity: int = 0):
+        self.name = name
+        self.capacity = capacity
+        self.active_orders = set()
+
+    def has_capacity(self) -> bool:
+        """Return whether a new delivery can be accepted in the zone."""
+        return self.capacity <= 0 or len(self.active_orders) < self.capacity
+
+    def as_dict(self):
+        """Return the zone as dict."""
+        return {"name": self.name, "capacity": self.capacity, "active": len(self.active_orders)}
+
+
+class DeliveryZones:
+    """Zip code to zone lookup in O(1): a table indexed by province plus a blacklist set.
+
+    Data file format:
+    {"blacklist": [zip_code | [first, last], ...],
+     "zones": [{"name": str, "provinces": [[first, last], ...], "capacity": int}, ...]}
+    """
+
+    def __init__(self, rules: dict):
+        self.zones = {}
+        self.__by_province = [None] * PROVINCES
+        self.__blacklist = set()
+        self.__order_zones = {}  # order_id -> zone with the order reserved
+        for entry in rules.get("blacklist", []):
+            if isinstance(entry, list):
+                self.__blacklist.update(range(entry[0], entry[1] + 1))
+            else:
+                self.__blacklist.add(entry)
+        for zone_rules in rules.get("zones", []):
+            zone = DeliveryZone(zone_rules["name"], zone_rules.get("capacity", 0))
+            self.zones[zone.name] = zone
+            for first, last in zone_rules["provinces"]:
+                for province in range(first, last + 1):
+                    self.__by_province[province] = zone
+
+    @classmethod
+    def from_file(cls, path: str = DELIVERY_ZONES_FILE):
+        """Loads the zone rules from a JSON file."""
+        with open(path, "r") as rules_file:
+            zones = cls(json.load(rules_file))
+        logger.info("%i delivery zones loaded from %s", len(zones.zones), path)
+        return zones
+
+    def zone_for(self, zip_code):
+        """Return the zone that serves *zip_code*, or None if it is not served."""
+        if zip_code is None or zip_code in self.__blacklist:
+            return None
+        province = zip_code // 1000  # Extraer código de provincia del código postal
+        if not 0 <= province < PROVINCES:
+            return None
+        return self.__by_province[province]
+
+    def reserve(self, zone: DeliveryZone, order_id: int) -> bool:
+        """Takes a slot of the zone for the order. Return False if the zone is full."""
+        if order_id in zone.active_orders:
+            return True
+        if not zone.has_capacity():
+            return False
+        zone.active_orders.add(order_id)
+        self.__order_zones[order_id] = zone
+        return True
+
+    def release(self, order_id: int):
+        """Frees the zone slot of a delivered or canceled order."""
+        zone = self.__order_zones.pop(order_id, None)
+        if zone is not None:
+            zone.active_orders.discard(order_id)
+
+    def zone_of_order(self, order_id: int):
+        """Return the zone reserved for the order, or None."""
+        return self.__order_zones.get(order_id)
+
+    def stats(self):
+        """Return the zones as list of dicts."""
+        return [zone.as_dict() for zone in self.zones.values()]
+
+
+delivery_zones = DeliveryZones.from_file()
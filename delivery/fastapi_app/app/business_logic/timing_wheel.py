@@ -0,0 +1,149 @@
+# -*- coding: utf-8 -*-
+"""Hierarchical timing wheel shared by the delivery service timers."""
+import asyncio
+import logging
+import math
+import os
+
+logger = logging.getLogger(__name__)
+
+TIMER_WHEEL_TICK = float(os.getenv("TIMER_WHEEL_TICK_MS", "100")) / 1000
+TIMER_WHEEL_SLOTS = int(os.getenv("TIMER_WHEEL_SLOTS", "64"))
+TIMER_WHEEL_LEVELS = int(os.getenv("TIMER_WHEEL_LEVELS", "4"))
+
+
+class Timer:
+    """Handle of a scheduled callback, used to cancel it."""
+    __slots__ = ("deadline", "callback", "args", "bucket", "wheel")
+
+    def __init__(self, deadline: int, callback, args, wheel):
+        self.deadline = deadline  # In ticks
+        self.callback = callback
+        self.args = args
+        self.bucket = None
+        self.wheel = wheel
+
+    def cancel(self):
+        """Cancels the timer in O(1). Does nothing if it already fired."""
+        self.wheel.cancel(self)
+
+
+class TimingWheel:
+    """Timers in *levels* wheels of *slots* buckets; level i buckets span tick * slots**i seconds.
+
+    Scheduling and canceling are O(1): a timer is stored in the bucket of the lowest level
+    that can hold its deadline and cascades to lower levels as time advances. Every tick the
+    due bucket of level 0 is fired as a batch. The number of pending timers is kept as a
+    counter. Callbacks are plain functions; coroutine results are run as tasks.
+    """
+
+    def __init__(self, tick: float = TIMER_WHEEL_TICK, slots: int = TIMER_WHEEL_SLOTS,
+                 levels: int = TIMER_WHEEL_LEVELS):
+        self.tick = tick
+        self.slots = slots
+        self.levels = levels
+        self.fired = 0
+        self.__pending = 0
+        self.__wheels = [[set() for _ in range(slots)] for _ in range(levels)]
+        self.__current_tick = 0
+        self.__start = None
+        self.__armed = asyncio.Event()
+
+    def __len__(self):
+        return self.__pending
+
+    def schedule(self, delay: float, callback, *args) -> Timer:
+        """Calls callback(*args) after *delay* seconds. Returns the timer handle."""
+        if self.__start is None:
+            self.__start = asyncio.get_running_loop().time()
+        elapsed = asyncio.get_running_loop().time() - self.__start
+        if self.__pending == 0:
+            # The wheel does not tick while idle: skip the idle ticks instead of replaying them
+            self.__current_tick = max(self.__current_tick, int(elapsed / self.tick))
+        deadline = max(self.__current_tick + 1, math.ceil((elapsed + delay) / self.tick))
+        timer = Timer(deadline, callback, args, self)
+        self.__insert(timer)
+        self.__pending += 1
+        self.__armed.set()
+        return timer
+
+    def cancel(self, timer: Timer):
+        """Cancels a timer in O(1). Does nothing if it already fired or was canceled."""
+        if timer.bucket is not None:
+            timer.bucket.discard(timer)
+            timer.bucket = None
+            self.__pending -= 1
+
+    def __insert(self, timer: Timer):
+        ticks = timer.deadline - self.__current_tick
+        span = 1
+        for level in range(self.levels):
+            if ticks < span * self.slots or level == self.levels - 1:
+                # Beyond the last level the timer is parked in its furthest bucket and cascades again
+                deadline = min(timer.deadline, self.__current_tick + span * self.slots - 1)
+                bucket = self.__wheels[level][(deadline // span) % self.slots]
+                bucket.add(timer)
+                timer.bucket = bucket
+                return
+            span *= self.slots
+
+    def __advance(self):
+        """Moves the wheel one tick, returning the timers that are due."""
+        self.__current_tick += 1
+        span = self.slots ** (self.levels - 1)
+        for level in range(self.levels - 1, 0, -1):
+            if self.__current_tick % span == 0:
+                bucket = self.__wheels[level][(self.__current_tick // span) % self.slots]
+                timers = list(bucket)
+                bucket.clear()
+                for timer in timers:
+                    self.__insert(timer)
+            span //= self.slots
+        bucket = self.__wheels[0][self.__current_tick % self.slots]
+        due = [timer for timer in bucket if timer.deadline <= self.__current_tick]
+        for timer in due:
+            bucket.discard(timer)
+            timer.bucket = None
+        self.__pending -= len(due)
+        return due
+
+    async def run(self):
+        """Coroutine that advances the wheel and fires the due timers."""
+        loop = asyncio.get_running_loop()
+        if self.__start is None:
+            self.__start = loop.time()
+        while True:
+            if self.__pending == 0:
+                self.__armed.clear()
+                await self.__armed.wait()
+            target_tick = int((loop.time() - self.__start) / self.tick)
+            due = []
+            while self.__current_tick < target_tick:
+                due.extend(self.__advance())
+            if due:
+                self.__fire(due)
+            next_tick_time = self.__start + (self.__current_tick + 1) * self.tick
+            await asyncio.sleep(max(0.0, next_tick_time - loop.time()))
+
+    def __fire(self, timers):
+        for timer in timers:
+            try:
+                result = timer.callback(*timer.args)
+                if asyncio.iscoroutine(result):
+                    asyncio.create_task(result)
+            except Exception as exc:
+                logger.error("Error in timer callback %s: %s", timer.callback, exc)
+        self.fired += len(timers)
+
+    def stats(self):
+        """Return the wheel counters as dict."""
+        return {
+            "tick": self.tick,
+            "slots": self.slots,
+            "levels": self.levels,
+            "pending": len(self),
+            "fired": self.fired
+        }
+
+
+timer_wheel = TimingWheel()
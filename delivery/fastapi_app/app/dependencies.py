@@ -18,6 +18,7 @@ async def get_db():
         await db.commit()
     except:
         await db.rollback()
+        raise  # HTTPExceptions del endpoint deben llegar al cliente
     finally:
         await db.close()
 
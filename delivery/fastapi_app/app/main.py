@@ -12,6 +12,7 @@ from app.sql import models
 from app.sql import database
 
 from app.routers import rabbitmq_publish_logs
+from app.business_logic.timing_wheel import timer_wheel
 import global_variables
 from global_variables.global_variables import update_system_resources_periodically, set_rabbitmq_status, get_rabbitmq_status
 
@@ -69,6 +70,8 @@ async def startup_event():
     try:
 
         logger.info("antes del subscribe")
+        async with database.engine.begin() as conn:
+            await conn.run_sync(models.Base.metadata.create_all)
 
         await rabbitmq.subscribe_channel()
         await rabbitmq_publish_logs.subscribe_channel(aio_pika.ExchangeType.TOPIC, EXCHANGE_NAME)
@@ -78,6 +81,8 @@ async def startup_event():
         asyncio.create_task(rabbitmq.subscribe_produced())
         asyncio.create_task(rabbitmq.subscribe_delivery_check())
         asyncio.create_task(rabbitmq.subscribe_delivery_cancel())
+        asyncio.create_task(timer_wheel.run())
+        asyncio.create_task(rabbitmq.delivery_scheduler.run())  # Resumes the pending deliveries
 
 
         message, routing_key = await rabbitmq_publish_logs.formato_log_message("debug", "inicializando Delivery correctamente")
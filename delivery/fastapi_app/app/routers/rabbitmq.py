@@ -4,7 +4,13 @@ import json
 from app.sql.database import SessionLocal  # pylint: disable=import-outside-toplevel
 from app.sql import crud, models
 from app.routers import rabbitmq_publish_logs
+from app.business_logic.delivery_zones import delivery_zones
+from app.business_logic.delivery_scheduler import DeliveryScheduler
+from app.business_logic.timing_wheel import timer_wheel
+from app.business_logic.delivery_runs import DeliveryRuns, DELIVERY_BATCHING, DELIVERY_RUN_SIZE
+import os
 import ssl
+import uuid
 import logging
 from global_variables.global_variables import update_system_resources_periodically, set_rabbitmq_status, get_rabbitmq_status
 
@@ -24,11 +30,21 @@ exchange_name = 'exchange'
 exchange_responses_name = 'responses'
 exchange_responses = None
 
+DELIVERY_TIME = float(os.getenv("DELIVERY_TIME", "1"))  # Segundos que tarda un reparto
+DELIVERY_SAGA_TIMEOUT = float(os.getenv("DELIVERY_SAGA_TIMEOUT", "3600"))  # Checked -> produced
+
+saga_timers = {}  # order_id -> timing wheel timer
+
+# Con DELIVERY_BATCHING debe ser >= DELIVERY_RUN_SIZE para que los repartos se llenen por tamaño
+PRODUCED_CONSUMER_CONCURRENCY = int(os.getenv("PRODUCED_CONSUMER_CONCURRENCY", "40"))
+produced_slots = asyncio.Semaphore(PRODUCED_CONSUMER_CONCURRENCY)
+in_flight_produced = set()
+
 async def subscribe_channel():
     """
     Conéctate a RabbitMQ utilizando SSL, declara los intercambios necesarios y configura el canal.
     """
-    global channel, exchange_commands, exchange, exchange_commands_name, exchange_name
+    global channel, exchange_commands, exchange, exchange_commands_name, exchange_name, exchange_responses
 
     try:
         logger.info("Intentando suscribirse...")
@@ -78,10 +94,11 @@ async def subscribe_channel():
 async def on_message_delivery_cancel(message):
     async with message.process():
         order = json.loads(message.body)
-        db = SessionLocal()
-        delivery = await crud.get_delivery_by_order(db, order['id_order'])
-        delivery = await crud.change_delivery_status(db, delivery.id_delivery, models.Delivery.STATUS_CANCELED)
-        await db.close()
+        disarm_saga_timeout(order['id_order'])
+        delivery_scheduler.cancel(order['id_order'])
+        async with SessionLocal() as db:
+            await crud.cancel_delivery(db, order['id_order'])  # Also drops the pending dispatch
+        delivery_zones.release(order['id_order'])
         data = {
             "id_order": order['id_order']
         }
@@ -104,32 +121,39 @@ async def subscribe_delivery_cancel():
 
 
 async def on_produced_message(message):
-    async with message.process():
+    # Si no se puede persistir el reparto el mensaje vuelve a la cola
+    async with message.process(requeue=True):
         order = json.loads(message.body)
-        db = SessionLocal()
-        db_delivery = await crud.get_delivery_by_order_id(db, order['id_order'])
-        # db_delivery = await crud.change_delivery_status(db, db_delivery.id_delivery, models.Delivery.STATUS_DELIVERING)
-        await db.close()
-        asyncio.create_task(send_product(db_delivery))
+        disarm_saga_timeout(order['id_order'])
+        if DELIVERY_BATCHING:
+            # Se agrupa con los demás pedidos de la zona; ack cuando el reparto está persistido
+            await delivery_runs.add(order_zone(order['id_order']), order['id_order'])
+            return
+        # The dispatch is persisted, the scheduler's workers deliver it when due
+        await delivery_scheduler.schedule(order['id_order'], DELIVERY_TIME)
+        message_body = json.dumps({"id_order": order['id_order']})
+        await publish_event(message_body, "events.order.inprocess")
 
 async def on_create_message(message):
     async with message.process():
         order = json.loads(message.body)
         db = SessionLocal()
-        address_check = await crud.check_address(db, order["user_id"])
+        # Address and zone come from in-memory caches, no DB round-trip in the common case
+        address_check = await crud.check_address(db, order["user_id"], order["id_order"])
         data = {
-            "id_order": order.order_id,
+            "id_order": order["id_order"],
             "status": address_check
         }
         if address_check:
             status_delivery_address_check = models.Delivery.STATUS_CREATED
+            arm_saga_timeout(order["id_order"])
         else:
             status_delivery_address_check = models.Delivery.STATUS_CANCELED
 
         delivery = await crud.create_delivery(db, order["id_order"], order["user_id"],status_delivery_address_check)
-        message = json.dumps(data)
+        message_body = json.dumps(data)
         routing_key = "events.delivery.checked"
-        await publish_event(message, routing_key)
+        await publish_event(message_body, routing_key)
         message, routing_key = await rabbitmq_publish_logs.formato_log_message("info", "delivery creado correctamente para el order " + str(delivery.order_id))
         await rabbitmq_publish_logs.publish_log(message, routing_key)
         routing_key = "delivery.checked"
@@ -154,11 +178,27 @@ async def subscribe_produced():
     queue = await channel.declare_queue(name=queue_name, exclusive=True)
     # Bind the queue to the exchange
     routing_key = "events.order.produced"
-    await queue.bind(exchange=exchange_events_name, routing_key=routing_key)
+    await queue.bind(exchange=exchange_name, routing_key=routing_key)
+    # RabbitMQ no entrega más mensajes sin ack que los que se pueden procesar a la vez
+    await channel.set_qos(prefetch_count=PRODUCED_CONSUMER_CONCURRENCY)
     # Set up a message consumer
     async with queue.iterator() as queue_iter:
         async for message in queue_iter:
-            await on_produced_message(message)
+            # Concurrent, so several produced orders can wait in the same zone run
+            await produced_slots.acquire()
+            task = asyncio.create_task(handle_produced_message(message))
+            in_flight_produced.add(task)
+            task.add_done_callback(in_flight_produced.discard)
+
+
+async def handle_produced_message(message):
+    """Processes one produced order message and frees its concurrency slot."""
+    try:
+        await on_produced_message(message)
+    except Exception as e:
+        logger.error(f"Error procesando el order producido: {e}")
+    finally:
+        produced_slots.release()
 
 async def subscribe_create():
     # Create queue
@@ -166,63 +206,93 @@ async def subscribe_create():
     queue = await channel.declare_queue(name=queue_name, exclusive=True)
     # Bind the queue to the exchange
     routing_key = "events.order.created"
-    await queue.bind(exchange=exchange_events_name, routing_key=routing_key)
+    await queue.bind(exchange=exchange_name, routing_key=routing_key)
     # Set up a message consumer
     async with queue.iterator() as queue_iter:
         async for message in queue_iter:
             await on_create_message(message)
 
 
-async def send_product(delivery):
-    data = {
-        "id_order": delivery.order_id
-    }
-    message_body = json.dumps(data)
-
-    # Publica el evento inicial con el estado "in process"
-    routing_key = "events.order.inprocess"
-    await publish_event(message_body, routing_key)
-
-    # Espera de 10 segundos
-    await asyncio.sleep(1)
-
-    # Actualiza el estado del delivery en la base de datos
-    db = SessionLocal()
-    db_delivery = await crud.get_delivery(db, delivery.id)
-    db_delivery = await crud.change_delivery_status_done(db, db_delivery.id)
-    await db.close()
-
-    # Cambia el routing_key en función del estado del delivery
-    if db_delivery.status == models.Delivery.STATUS_DELIVERED:
-        routing_key = "events.order.delivered"
-    elif db_delivery.status == models.Delivery.STATUS_COMPLETED:
-        routing_key = "events.order.completed"
-    else:
-        # En caso de otros estados, se puede definir un routing_key predeterminado o manejar el error
-        # logger.warning("Estado inesperado para delivery %s: %s", delivery.id_order, db_delivery.status)
+def order_zone(order_id: int):
+    """Zone name of the order (reserved when its address was checked), None if unknown."""
+    zone = delivery_zones.zone_of_order(order_id)
+    return zone.name if zone else None
+
+
+def delivery_message(order_ids, zone=None):
+    """Body of the order delivery events: one order, or the orders of a run."""
+    if len(order_ids) == 1 and zone is None:
+        return json.dumps({"id_order": order_ids[0], "id": order_ids[0]})  # Orders lee la clave "id"
+    return json.dumps({"id_orders": list(order_ids), "zone": zone})
+
+
+async def start_delivery_run(zone, order_ids):
+    """Persists the dispatch of a zone run and publishes one in process event for it."""
+    await delivery_scheduler.schedule_many(order_ids, DELIVERY_TIME)
+    await publish_event(delivery_message(order_ids, zone), "events.order.inprocess")
+
+
+async def complete_deliveries(order_ids):
+    """Delivers due orders: updates their status and publishes one delivered event."""
+    async with SessionLocal() as db:
+        delivered = await crud.complete_dispatches(db, order_ids)
+    zone = order_zone(order_ids[0]) if DELIVERY_BATCHING else None
+    for order_id in order_ids:
+        delivery_zones.release(order_id)
+    if not delivered:
+        logger.info("Delivery of orders %s canceled before dispatch", order_ids)
         return
 
-    # Publica el evento final basado en el estado actualizado
-    await publish_event(message_body, routing_key)
-    message, routing_key = rabbitmq_publish_logs.formato_log_message("info", "delivery actualizado a " + db_delivery.status + "correctamente para el order " + db_delivery.order_id)
+    await publish_event(delivery_message(delivered, zone), "events.order.delivered")
+    message, routing_key = await rabbitmq_publish_logs.formato_log_message(
+        "info", "delivery actualizado a " + models.Delivery.STATUS_DELIVERED + " correctamente para los orders " + str(delivered)
+    )
     await rabbitmq_publish_logs.publish_log(message, routing_key)
 
 
+if DELIVERY_BATCHING:
+    delivery_scheduler = DeliveryScheduler(complete_deliveries, group=order_zone, run_size=DELIVERY_RUN_SIZE)
+else:
+    delivery_scheduler = DeliveryScheduler(complete_deliveries)
+delivery_runs = DeliveryRuns(start_delivery_run)
+
+
+def arm_saga_timeout(order_id: int):
+    """Frees the order's zone reservation if it is not produced within DELIVERY_SAGA_TIMEOUT."""
+    disarm_saga_timeout(order_id)
+    saga_timers[order_id] = timer_wheel.schedule(DELIVERY_SAGA_TIMEOUT, on_saga_timeout, order_id)
+
+
+def disarm_saga_timeout(order_id: int):
+    """Cancels the saga deadline of an order."""
+    timer = saga_timers.pop(order_id, None)
+    if timer is not None:
+        timer.cancel()
+
+
+def on_saga_timeout(order_id: int):
+    saga_timers.pop(order_id, None)
+    delivery_zones.release(order_id)
+    logger.warning("Order %i not produced in %i s, delivery zone released", order_id, DELIVERY_SAGA_TIMEOUT)
+
+
 async def publish_response(message_body, routing_key):
     # Publish the message to the exchange
     await exchange_responses.publish(
         aio_pika.Message(
             body=message_body.encode(),
-            content_type="text/plain"
+            content_type="text/plain",
+            message_id=uuid.uuid4().hex
         ),
         routing_key=routing_key)
 
 
 async def publish_event(message_body, routing_key):
     # Publish the message to the exchange
-    await exchange_events.publish(
+    await exchange.publish(
         aio_pika.Message(
             body=message_body.encode(),
-            content_type="text/plain"
+            content_type="text/plain",
+            message_id=uuid.uuid4().hex
         ),
         routing_key=routing_key)
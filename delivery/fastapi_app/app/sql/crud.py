@@ -19,6 +19,8 @@ from datetime import datetime
 import logging
 from sqlalchemy.exc import SQLAlchemyError
 from fastapi import HTTPException, status
+from app.business_logic.address_cache import address_cache, MISSING
+from app.business_logic.delivery_zones import delivery_zones
 
 logging.basicConfig(level=logging.DEBUG)
 logger = logging.getLogger(__name__)
@@ -37,6 +39,7 @@ async def create_address(db: AsyncSession, user_id: int, address: str, zip_code:
         existing_address.zip_code = zip_code
         await db.commit()
         await db.refresh(existing_address)
+        address_cache.invalidate(user_id)
         logger.debug("Address updated for user_id %s with address: %s", user_id, address)
         return existing_address
 
@@ -45,6 +48,7 @@ async def create_address(db: AsyncSession, user_id: int, address: str, zip_code:
     db.add(new_address)
     await db.commit()
     await db.refresh(new_address)
+    address_cache.invalidate(user_id)
     logger.debug("Address created for user_id %s with address: %s", user_id, address)
     return new_address
 
@@ -87,6 +91,29 @@ async def create_delivery(db: AsyncSession, order_id: int, user_id: int, deliver
         raise HTTPException(status_code=500, detail="Unexpected error occurred")
 
 
+async def update_deliveries_status(db: AsyncSession, statuses: dict):
+    """Set a different status for each order ({order_id: status}) with one UPDATE ... IN.
+
+    Return {order_id: row} of the updated deliveries.
+    """
+    result = await db.execute(
+        update(models.Delivery)
+        .where(models.Delivery.order_id.in_(list(statuses)))
+        .values(status=case(statuses, value=models.Delivery.order_id))
+        .returning(models.Delivery.order_id, models.Delivery.user_id, models.Delivery.status)
+    )
+    rows = result.all()
+    await db.commit()
+    logger.debug("%i of %i deliveries updated", len(rows), len(statuses))
+    return {row.order_id: row for row in rows}
+
+
+async def get_deliveries_by_order_ids(db: AsyncSession, order_ids):
+    """Obtener varios deliveries con un solo SELECT ... IN. Return {order_id: delivery}."""
+    result = await db.execute(select(models.Delivery).where(models.Delivery.order_id.in_(order_ids)))
+    return {delivery.order_id: delivery for delivery in result.scalars()}
+
+
 async def update_address(db: AsyncSession, user_id: int, address: Optional[str], zip_code: Optional[int]):
     """Actualizar la dirección para un usuario."""
     async with db.begin():
@@ -101,6 +128,7 @@ async def update_address(db: AsyncSession, user_id: int, address: Optional[str],
         )
         result = await db.execute(stmt)
         await db.commit()
+    address_cache.invalidate(user_id)
 
     if result.rowcount == 0:
         logger.debug("No address found for user_id %s. Update skipped.", user_id)
@@ -109,15 +137,30 @@ async def update_address(db: AsyncSession, user_id: int, address: Optional[str],
     logger.debug("Address updated for user_id %s", user_id)
     return await get_address_by_user_id(db, user_id)
 
-async def check_address(db: AsyncSession, user_id):
-    """Persist a new client into the database."""
-    address = get_address_by_user_id(db, user_id)
-    provincia = address.zip_code // 1000 # Extraer código de provincia del código postal
-    if (provincia == 1 or provincia == 20 or provincia == 48):
-        address_check = True
-    else:
-        address_check = False
-    return address_check
+async def get_user_zip_code(db: AsyncSession, user_id: int):
+    """Return the zip code of the user's address (None if there is no address), cached."""
+    zip_code = address_cache.get(user_id)
+    if zip_code is MISSING:
+        generation = address_cache.generation
+        address = await get_address_by_user_id(db, user_id)
+        zip_code = address.zip_code if address else None
+        address_cache.put(user_id, zip_code, generation)
+    return zip_code
+
+
+async def get_delivery_zone(db: AsyncSession, user_id: int):
+    """Return the delivery zone of the user's address, or None if it is not served."""
+    return delivery_zones.zone_for(await get_user_zip_code(db, user_id))
+
+
+async def check_address(db: AsyncSession, user_id, order_id: int = None):
+    """Return whether the user's address can be served. Reserves zone capacity for *order_id*."""
+    zone = await get_delivery_zone(db, user_id)
+    if zone is None:
+        return False
+    if order_id is None:
+        return zone.has_capacity()
+    return delivery_zones.reserve(zone, order_id)
 
 async def update_delivery(db: AsyncSession, order_id: int, status: Optional[str]):
     """Actualizar el estado de un delivery."""
@@ -147,6 +190,7 @@ async def delete_address(db: AsyncSession, user_id: int):
         stmt = delete(models.UserAddress).where(models.UserAddress.user_id == user_id)
         result = await db.execute(stmt)
         await db.commit()
+    address_cache.invalidate(user_id)
 
     if result.rowcount == 0:
         logger.debug("No address found for user_id %s. Delete skipped.", user_id)
@@ -177,4 +221,111 @@ async def get_address_by_user_id(db: AsyncSession, user_id: int):
 async def get_delivery_by_order_id(db: AsyncSession, order_id: int):
     """Obtener un delivery por order_id."""
     result = await db.execute(select(models.Delivery).where(models.Delivery.order_id == order_id))
-    return result.scalars().first()
\ No newline at end of file
+    return result.scalars().first()
+
+async def schedule_dispatches(db: AsyncSession, order_ids, scheduled_at: datetime):
+    """Marks the deliveries in progress and persists their dispatch, in one transaction."""
+    result = await db.execute(
+        select(models.DeliveryDispatch).where(models.DeliveryDispatch.order_id.in_(order_ids))
+    )
+    existing = {dispatch.order_id: dispatch for dispatch in result.scalars()}
+    for order_id in order_ids:
+        if order_id in existing:
+            existing[order_id].scheduled_at = scheduled_at
+            existing[order_id].attempts += 1
+        else:
+            db.add(models.DeliveryDispatch(order_id=order_id, scheduled_at=scheduled_at, attempts=0))
+    await db.execute(
+        update(models.Delivery)
+        .where(models.Delivery.order_id.in_(order_ids))
+        .values(status=models.Delivery.STATUS_IN_PROGRESS)
+    )
+    await db.commit()
+    logger.debug("Delivery of orders %s scheduled at %s", order_ids, scheduled_at)
+
+
+async def get_due_dispatches(db: AsyncSession, now: datetime, limit: int, exclude=()):
+    """Return up to *limit* order ids whose dispatch is due, oldest first (uses the scheduled_at index)."""
+    stmt = (
+        select(models.DeliveryDispatch.order_id)
+        .where(models.DeliveryDispatch.scheduled_at <= now)
+        .order_by(models.DeliveryDispatch.scheduled_at)
+        .limit(limit)
+    )
+    if exclude:
+        stmt = stmt.where(models.DeliveryDispatch.order_id.not_in(list(exclude)))
+    result = await db.execute(stmt)
+    return result.scalars().all()
+
+
+async def get_pending_dispatches(db: AsyncSession):
+    """Return (order_id, scheduled_at) of every pending dispatch."""
+    result = await db.execute(
+        select(models.DeliveryDispatch.order_id, models.DeliveryDispatch.scheduled_at)
+    )
+    return result.all()
+
+
+async def retry_dispatches(db: AsyncSession, order_ids, scheduled_at: datetime, max_attempts: int):
+    """Reschedules failed dispatches at *scheduled_at*, counting the attempt, in one transaction.
+
+    Dispatches that reach *max_attempts* are removed and their deliveries marked failed.
+    Return the order ids given up.
+    """
+    result = await db.execute(
+        delete(models.DeliveryDispatch)
+        .where(models.DeliveryDispatch.order_id.in_(order_ids))
+        .where(models.DeliveryDispatch.attempts + 1 >= max_attempts)
+        .returning(models.DeliveryDispatch.order_id)
+    )
+    given_up = result.scalars().all()
+    if given_up:
+        await db.execute(
+            update(models.Delivery)
+            .where(models.Delivery.order_id.in_(given_up))
+            .values(status=models.Delivery.STATUS_FAILED)
+        )
+    await db.execute(
+        update(models.DeliveryDispatch)
+        .where(models.DeliveryDispatch.order_id.in_(order_ids))
+        .values(scheduled_at=scheduled_at, attempts=models.DeliveryDispatch.attempts + 1)
+    )
+    await db.commit()
+    return given_up
+
+
+async def complete_dispatches(db: AsyncSession, order_ids):
+    """Removes the dispatches and marks the deliveries delivered with one UPDATE.
+
+    Return the delivered order ids; orders canceled meanwhile have no dispatch and are skipped.
+    """
+    result = await db.execute(
+        delete(models.DeliveryDispatch)
+        .where(models.DeliveryDispatch.order_id.in_(order_ids))
+        .returning(models.DeliveryDispatch.order_id)
+    )
+    delivered = result.scalars().all()
+    if not delivered:
+        await db.rollback()
+        return []
+    await db.execute(
+        update(models.Delivery)
+        .where(models.Delivery.order_id.in_(delivered))
+        .values(status=models.Delivery.STATUS_DELIVERED)
+    )
+    await db.commit()
+    return delivered
+
+
+async def cancel_delivery(db: AsyncSession, order_id: int):
+    """Marks the delivery canceled and removes its pending dispatch, in one transaction."""
+    await db.execute(
+        delete(models.DeliveryDispatch).where(models.DeliveryDispatch.order_id == order_id)
+    )
+    result = await db.execute(
+        update(models.Delivery)
+        .where(models.Delivery.order_id == order_id)
+        .values(status=models.Delivery.STATUS_CANCELED)
+    )
+    await db.commit()
+    return result.rowcount > 0
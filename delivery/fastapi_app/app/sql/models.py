@@ -82,6 +82,8 @@ class Delivery(Base):
     STATUS_CREATED = "created"
     STATUS_CANCELED = "canceled"
     STATUS_COMPLETED = "completed"
+    STATUS_DELIVERED = "delivered"
+    STATUS_FAILED = "failed"  # Dispatch given up after too many attempts
 
     __tablename__ = "deliveries"
 
@@ -93,6 +95,15 @@ class Delivery(Base):
         default=STATUS_IN_PROGRESS,  # Estado inicial permitido
     )
 
+class DeliveryDispatch(Base):
+    """Pending delivery dispatch, persisted so it is resumed after a restart."""
+    __tablename__ = "delivery_dispatch"
+
+    order_id = Column(Integer, primary_key=True)
+    scheduled_at = Column(DateTime, nullable=False, index=True)
+    attempts = Column(Integer, nullable=False, default=0)
+
+
 class UserAddress(Base):
     __tablename__ = "user_address"
 
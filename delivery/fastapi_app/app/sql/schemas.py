@@ -158,4 +158,30 @@ class Delivery(DeliveryBase):
     user_id: int
 
     class Config:
-        orm_mode = True
\ No newline at end of file
+        orm_mode = True
+
+
+class DeliveryStatusItem(BaseModel):
+    """New status of one delivery in a batch update."""
+    order_id: int = Field(
+        description="Unique ID of the order",
+        example=123
+    )
+    status: str = Field(
+        description="New status of the delivery",
+        example="delivered"
+    )
+
+
+class DeliveryStatusBatch(BaseModel):
+    """Schema for updating the status of several deliveries at once."""
+    items: List[DeliveryStatusItem] = Field(description="Deliveries to update")
+
+
+class DeliveryBatchResult(BaseModel):
+    """Per order result of a batch lookup or update, streamed as one NDJSON line."""
+    order_id: int = Field(description="Unique ID of the order", example=123)
+    user_id: Optional[int] = Field(default=None, description="ID of the user of the delivery", example=1)
+    status: Optional[str] = Field(default=None, description="Status of the delivery", example="delivered")
+    detail: Optional[str] = Field(default=None, description="Error message if the delivery could not be processed",
+                                  example="Delivery not found")
@@ -2,8 +2,8 @@
 """Simulation of a machine that manufactures pieces."""
 import asyncio
 import logging
+import os
 import requests
-from random import randint
 
 from httpx import AsyncClient
 from sqlalchemy.ext.asyncio import AsyncSession
@@ -12,160 +12,213 @@ from app.sql import crud
 from app.sql.models import Piece, Order
 from app.sql.database import SessionLocal
 from ..sql import schemas
+from .piece_queue import PieceQueue
+from .machine_state import machine_state
+from .clock import machine_clock, manufacturing_durations
+from .queue_journal import queue_journal, OP_ENQUEUE, OP_START, OP_FINISH, OP_CANCEL
 
 logger = logging.getLogger(__name__)
 logger.debug("Machine logger set.")
 
+MACHINE_WORKERS = int(os.getenv("MACHINE_WORKERS", "1"))
+RECOVERY_CHUNK_SIZE = int(os.getenv("RECOVERY_CHUNK_SIZE", "500"))
 
-class Machine:
-    """Piece manufacturing machine simulator."""
+
+class MachineWorker:
+    """One manufacturing line of the machine. Each worker builds one piece at a time."""
     STATUS_WAITING = "Waiting"
     STATUS_CHANGING_PIECE = "Changing Piece"
     STATUS_WORKING = "Working"
-    __manufacturing_queue = asyncio.Queue()
+
+    def __init__(self, worker_id: int):
+        self.id = worker_id
+        self.status = MachineWorker.STATUS_WAITING
+        self.working_piece = None
+        self.pieces_manufactured = 0
+
+    def as_dict(self):
+        """Return the worker state as dict."""
+        return {
+            "id": self.id,
+            "status": self.status,
+            "working_piece": self.working_piece['id'] if self.working_piece else None,
+            "pieces_manufactured": self.pieces_manufactured
+        }
+
+
+class Machine:
+    """Piece manufacturing machine simulator: a pool of workers sharing one queue."""
+    STATUS_WAITING = MachineWorker.STATUS_WAITING
+    STATUS_CHANGING_PIECE = MachineWorker.STATUS_CHANGING_PIECE
+    STATUS_WORKING = MachineWorker.STATUS_WORKING
+    __manufacturing_queue = PieceQueue()
     __stop_machine = False
-    working_piece = None
-    status = STATUS_WAITING
+
+    def __init__(self, number_of_workers: int = MACHINE_WORKERS):
+        self.workers = [MachineWorker(worker_id) for worker_id in range(max(number_of_workers, 1))]
+        self.recovery = {"recovering": False, "recovered_pieces": 0}
 
     @classmethod
-    async def create(cls):
+    async def create(cls, number_of_workers: int = MACHINE_WORKERS):
         """Machine constructor: loads manufacturing/queued pieces and starts simulation."""
-        logger.info("AsyncMachine initialized")
-        self = Machine()
-        asyncio.create_task(self.manufacturing_coroutine())
-        await self.reload_queue_from_database()
+        logger.info("AsyncMachine initialized with %i workers", number_of_workers)
+        self = Machine(number_of_workers)
+        self.publish_state()
+        for worker in self.workers:
+            asyncio.create_task(self.manufacturing_coroutine(worker))
+        # The queue is recovered in the background, the service is usable meanwhile
+        self.recovery["recovering"] = True
+        if queue_journal.exists():
+            queue_journal.begin_load()  # Operations of the workers wait for the replay
+            asyncio.create_task(self.reload_queue_from_journal())
+        else:
+            asyncio.create_task(self.reload_queue_from_database())
+        asyncio.create_task(queue_journal.run())
         return self
 
-    async def reload_queue_from_database(self):
-        """Reload queue from database, to reload data when the system has been rebooted."""
-        # Load the piece that was being manufactured
-        async with SessionLocal() as db:
-            manufacturing_piece = await Machine.get_manufacturing_piece(db)
-            if manufacturing_piece:
-                await self.add_piece_to_queue(manufacturing_piece)
+    @property
+    def status(self):
+        """Aggregated status: working if any worker is working."""
+        statuses = [worker.status for worker in self.workers]
+        for status in (Machine.STATUS_WORKING, Machine.STATUS_CHANGING_PIECE):
+            if status in statuses:
+                return status
+        return Machine.STATUS_WAITING
+
+    def working_piece_ids(self):
+        """Ids of the pieces being manufactured right now."""
+        return [worker.working_piece['id'] for worker in self.workers if worker.working_piece]
+
+    def publish_state(self):
+        """Publishes the current state of the machine for the status endpoint."""
+        working_pieces = self.working_piece_ids()
+        machine_state.publish({
+            "status": self.status,
+            "working_piece": working_pieces[0] if working_pieces else None,
+            "queue_depth": len(self.__manufacturing_queue),
+            "workers": [worker.as_dict() for worker in self.workers],
+            "pieces_manufactured": sum(worker.pieces_manufactured for worker in self.workers),
+            "recovery": dict(self.recovery)
+        })
 
-            # Load the pieces that were in the queue
-            queued_pieces = await Machine.get_queued_pieces(db)
-
-            if queued_pieces:
-                await self.add_pieces_to_queue(queued_pieces)
-            await db.close()
+    async def reload_queue_from_database(self):
+        """Reload queue from database, to reload data when the system has been rebooted.
 
-    @staticmethod
-    async def get_manufacturing_piece(db: AsyncSession):
-        """Gets the manufacturing piece from the database."""
+        Piece ids are read in keyset paginated chunks: first the pieces that were being
+        manufactured, then the queued ones.
+        """
+        self.recovery = {"recovering": True, "recovered_pieces": 0}
+        self.publish_state()
         try:
-            manufacturing_pieces = await crud.get_piece_list_by_status(
-                db,
-                Piece.STATUS_MANUFACTURING
-            )
-            if manufacturing_pieces and manufacturing_pieces[0]:
-                return manufacturing_pieces[0]
+            for status in (Piece.STATUS_MANUFACTURING, Piece.STATUS_QUEUED):
+                await self.reload_pieces_by_status(status)
         except (ProgrammingError, OperationalError):
-            logger.error(
-                "Error getting Manufacturing Piece at startup. It may be the first execution"
-            )
-        return None
-
-    @staticmethod
-    async def get_queued_pieces(db: AsyncSession):
-        """Get all queued pieces from the database."""
+            logger.error("Error getting pieces at startup. It may be the first execution")
+        finally:
+            self.recovery["recovering"] = False
+            self.publish_state()
+            logger.info("Queue recovered: %i pieces", self.recovery["recovered_pieces"])
+
+    async def reload_queue_from_journal(self):
+        """Reload queue replaying the queue journal, without querying the database.
+
+        Pieces that were being manufactured are queued first.
+        """
+        self.recovery = {"recovering": True, "recovered_pieces": 0}
+        self.publish_state()
         try:
-            queued_pieces = await crud.get_piece_list_by_status(db, Piece.STATUS_QUEUED)
-            return queued_pieces
-        except (ProgrammingError, OperationalError):
-            logger.error("Error getting Queued Pieces at startup. It may be the first execution")
-            return []
-
-    async def manufacturing_coroutine(self) -> None:
-        """Coroutine that manufactures queued pieces one by one."""
+            started, queued = await queue_journal.load()
+            for piece_id, order_id in started:
+                self.__manufacturing_queue.put_nowait(piece_id, order_id)
+            for piece_id, order_id in queued:
+                self.__manufacturing_queue.put_nowait(piece_id, order_id)
+            self.recovery["recovered_pieces"] = len(started) + len(queued)
+        except (OSError, ValueError, KeyError, TypeError) as exc:
+            logger.error("Could not replay the queue journal, reloading from database: %s", exc)
+            await self.reload_queue_from_database()
+            return
+        self.recovery["recovering"] = False
+        self.publish_state()
+        logger.info("Queue recovered from journal: %i pieces", self.recovery["recovered_pieces"])
+
+    async def reload_pieces_by_status(self, status):
+        """Adds to the queue all the pieces with the given status, one chunk at a time."""
+        after_id = None
+        while True:
+            async with SessionLocal() as db:
+                rows = await crud.get_piece_ids_by_status_page(db, status, after_id, RECOVERY_CHUNK_SIZE)
+            for piece_id, order_id in rows:
+                self.__manufacturing_queue.put_nowait(piece_id, order_id)
+                queue_journal.record(OP_ENQUEUE, piece_id, order_id)
+            self.recovery["recovered_pieces"] += len(rows)
+            self.publish_state()
+            if len(rows) < RECOVERY_CHUNK_SIZE:
+                return
+            after_id = rows[-1][0]
+
+    async def manufacturing_coroutine(self, worker: MachineWorker) -> None:
+        """Coroutine that manufactures queued pieces one by one in the given worker."""
         while not self.__stop_machine:
             if self.__manufacturing_queue.empty():
-                self.status = self.STATUS_WAITING
+                worker.status = MachineWorker.STATUS_WAITING
+                self.publish_state()
             piece_id = await self.__manufacturing_queue.get()
-            await self.create_piece(piece_id)
-            self.__manufacturing_queue.task_done()
-
-    async def create_piece(self, piece_id: int):
+            try:
+                await self.create_piece(piece_id, worker)
+            except Exception as exc:  # A failed piece must not stop the worker
+                logger.error("Worker %i could not manufacture piece %i: %s", worker.id, piece_id, exc)
+                worker.working_piece = None
+                self.publish_state()
+
+    async def create_piece(self, piece_id: int, worker: MachineWorker):
         """Simulates piece manufacturing."""
         # Machine and piece status updated during manufacturing
         async with SessionLocal() as db:
-            await self.update_working_piece(piece_id, db)
-            await self.working_piece_to_manufacturing(db)  # Update Machine&piece status
-            await db.close()
-
-        await asyncio.sleep(randint(1, 2))  # Simulates time spent manufacturing
-
-        async with SessionLocal() as db:
-            await self.working_piece_to_finished(db)  # Update Machine&Piece status
-            await db.close()
+            await self.working_piece_to_manufacturing(piece_id, db, worker)  # Update Machine&piece status
 
-        #Sends notification to order, the order has been finished
+        if worker.working_piece is None:  # Piece removed from the database
+            return
 
-        self.working_piece = None
-
-    async def update_working_piece(self, piece_id: int, db: AsyncSession):
-        """Loads a piece for the given id and updates the working piece."""
-        logger.debug("Updating working piece to %i", piece_id)
-        piece = await crud.get_piece(db, piece_id)
-        self.working_piece = piece.as_dict()
-
-    async def working_piece_to_manufacturing(self, db: AsyncSession):
-        """Updates piece status to manufacturing."""
-        self.status = Machine.STATUS_WORKING
-        try:
-            await crud.update_piece_status(db, self.working_piece['id'], Piece.STATUS_MANUFACTURING)
-        except Exception as exc:  # @ToDo: To general exception
-            logger.error("Could not update working piece status to manufacturing: %s", exc)
+        await machine_clock.sleep(manufacturing_durations.next())  # Simulates time spent manufacturing
 
-    async def working_piece_to_finished(self, db: AsyncSession):
-        """Updates piece status to finished and order if all pieces are finished."""
+        async with SessionLocal() as db:
+            await self.working_piece_to_finished(db, worker)  # Update Machine&Piece status
+
+        queue_journal.record(OP_FINISH, piece_id)
+        worker.working_piece = None
+        worker.pieces_manufactured += 1
+        machine_state.record_piece_finished()
+        self.publish_state()
+
+    async def working_piece_to_manufacturing(self, piece_id: int, db: AsyncSession, worker: MachineWorker):
+        """Updates piece status to manufacturing and loads it as the worker's working piece."""
+        logger.debug("Worker %i updating working piece to %i", worker.id, piece_id)
+        worker.working_piece = await crud.start_piece_manufacturing(db, piece_id)
+        if worker.working_piece is None:
+            logger.warning("Piece %i not found, it cannot be manufactured", piece_id)
+            return
+        worker.status = MachineWorker.STATUS_WORKING
+        queue_journal.record(OP_START, piece_id, worker.working_piece['order_id'])
+        self.publish_state()
+
+    async def working_piece_to_finished(self, db: AsyncSession, worker: MachineWorker):
+        """Updates piece status to finished and notifies the order if all pieces are finished."""
         logger.debug("Working piece finished.")
-        self.status = Machine.STATUS_CHANGING_PIECE
-
-        piece = await crud.update_piece_status(
-            db,
-            self.working_piece['id'],
-            Piece.STATUS_MANUFACTURED
-        )
-        self.working_piece = piece.as_dict()
-
-        piece = await crud.update_piece_manufacturing_date_to_now(
-            db,
-            self.working_piece['id']
-        )
-        self.working_piece = piece.as_dict()
+        worker.status = MachineWorker.STATUS_CHANGING_PIECE
+
+        piece, unfinished_pieces = await crud.finish_piece_manufacturing(db, worker.working_piece['id'])
+        if piece is None:
+            return
+        worker.working_piece = piece
         logger.debug(piece)
-        logger.debug(self.working_piece['order_id'])
-        print(await Machine.is_order_finished(self.working_piece['order_id'], db))
-        if await Machine.is_order_finished(self.working_piece['order_id'], db):
-            """await crud.update_order_status(
-                db,
-                self.working_piece['order_id'],
-                Order.STATUS_FINISHED
-            )"""
-            logger.debug(f"Se va a actualizar el estado de order a finished con el id {self.working_piece['order_id']}")
+        if unfinished_pieces == 0:
+            logger.debug(f"Se va a actualizar el estado de order a finished con el id {piece['order_id']}")
             # Usar httpx.AsyncClient para la llamada
             async with AsyncClient() as client:
-                response = await client.post(f"http://host.docker.internal:8002/order_finished/?id={str(self.working_piece['order_id'])}")
+                response = await client.post(f"http://host.docker.internal:8002/order_finished/?id={str(piece['order_id'])}")
                 if response.status_code != 200:
                     logger.error(f"Error en la llamada a order_finished: {response.status_code} - {response.text}")
 
-    @staticmethod
-    async def is_order_finished(order_id, db: AsyncSession):
-        """Return whether an order is finished or not."""
-        db_order = await crud.get_order(db, order_id)
-        if not db_order:  # Just in case order has been removed
-            logger.debug("Error buscando el order en machine")
-            return False
-
-        for piece in db_order.pieces:
-            logger.debug(piece.status)
-            if piece.status != Piece.STATUS_MANUFACTURED:
-                return False
-
-        return True
-
     async def add_pieces_to_queue(self, pieces):
         """Adds a list of pieces to the queue and updates their status."""
         logger.debug("Adding %i pieces to queue", len(pieces))
@@ -173,11 +226,13 @@ class Machine:
             await self.add_piece_to_queue(piece)
 
     async def add_piece_to_queue(self, piece):
-        """Adds the given piece from the queue."""
-        await self.__manufacturing_queue.put(piece.id)
+        """Adds the given piece to the queue."""
+        await self.__manufacturing_queue.put(piece.id, piece.order_id)
+        queue_journal.record(OP_ENQUEUE, piece.id, piece.order_id)
+        self.publish_state()
 
     async def remove_pieces_from_queue(self, pieces):
-        """Adds a list of pieces to the queue and updates their status."""
+        """Removes a list of pieces from the queue."""
         logger.debug("Removing %i pieces from queue", len(pieces))
         for piece in pieces:
             await self.remove_piece_from_queue(piece)
@@ -185,33 +240,32 @@ class Machine:
     async def remove_piece_from_queue(self, piece) -> bool:
         """Removes the given piece from the queue."""
         logger.info("Removing piece %i", piece.id)
-        if self.working_piece == piece.id:
+        if piece.id in self.working_piece_ids():
             logger.warning(
                 "Piece %i is being manufactured, cannot remove from queue\n\n",
                 piece.id
             )
             return False
 
-        item_list = []
-        removed = False
-        # Empty the list
-        while not self.__manufacturing_queue.empty():
-            item_list.append(self.__manufacturing_queue.get_nowait())
-
-        # Fill the list with all items but *piece_id*
-        for item in item_list:
-            if item != piece.id:
-                self.__manufacturing_queue.put_nowait(item)
-            else:
-                logging.debug("Piece %i removed from queue.", piece.id)
-                removed = True
-
-        if not removed:
+        removed = self.__manufacturing_queue.remove(piece.id)
+        if removed:
+            queue_journal.record(OP_CANCEL, piece.id)
+        self.publish_state()
+        if removed:
+            logging.debug("Piece %i removed from queue.", piece.id)
+        else:
             logger.warning("Piece %i not found in the queue.", piece.id)
 
         return removed
 
+    async def get_scheduler_stats(self):
+        """Scheduling policy and per-order wait time statistics of the queue."""
+        return {
+            "policy": self.__manufacturing_queue.policy,
+            "queued_pieces": len(self.__manufacturing_queue),
+            "orders": self.__manufacturing_queue.wait_stats()
+        }
+
     async def list_queued_pieces(self):
         """Get queued piece ids as list."""
-        piece_list = list(self.__manufacturing_queue.__dict__['_queue'])
-        return piece_list
+        return self.__manufacturing_queue.snapshot()
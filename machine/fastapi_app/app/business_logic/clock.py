@@ -0,0 +1,96 @@
+# -*- coding: utf-8 -*-
+"""Clocks and manufacturing durations for the machine simulator."""
+import asyncio
+import heapq
+import itertools
+import os
+import random
+import time
+
+MACHINE_CLOCK = os.getenv("MACHINE_CLOCK", "real")
+MACHINE_SEED = os.getenv("MACHINE_SEED")
+MACHINE_MIN_DURATION = int(os.getenv("MACHINE_MIN_DURATION", "1"))
+MACHINE_MAX_DURATION = int(os.getenv("MACHINE_MAX_DURATION", "2"))
+
+
+class RealClock:
+    """Wall clock: sleeping takes real time."""
+
+    @staticmethod
+    def now() -> float:
+        """Current time in seconds."""
+        return time.monotonic()
+
+    @staticmethod
+    async def sleep(seconds: float):
+        """Waits the given seconds."""
+        await asyncio.sleep(seconds)
+
+
+class VirtualClock:
+    """Virtual clock: sleeping advances the time instantly.
+
+    Sleepers are kept in a heap by wake-up time. Wake-ups run on the event loop one at a
+    time: each resumes the earliest sleeper, moves the clock to its wake-up time and
+    schedules the next wake-up behind the resumed task, so a sleeper that goes back to
+    sleep is ordered against the others in virtual time.
+    """
+
+    def __init__(self, start: float = 0.0):
+        self.__now = start
+        self.__sleepers = []
+        self.__sequence = itertools.count()
+        self.__wake_scheduled = False
+
+    def now(self) -> float:
+        """Current virtual time in seconds."""
+        return self.__now
+
+    async def sleep(self, seconds: float):
+        """Waits the given virtual seconds."""
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        heapq.heappush(self.__sleepers, (self.__now + max(seconds, 0), next(self.__sequence), future))
+        if not self.__wake_scheduled:
+            self.__wake_scheduled = True
+            loop.call_soon(self.__wake_next)
+        await future
+
+    def __wake_next(self):
+        self.__wake_scheduled = False
+        while self.__sleepers:
+            wake_at, _, future = heapq.heappop(self.__sleepers)
+            if future.cancelled():
+                continue
+            self.__now = max(self.__now, wake_at)
+            future.set_result(None)
+            break
+        if self.__sleepers:
+            self.__wake_scheduled = True
+            asyncio.get_running_loop().call_soon(self.__wake_next)
+
+
+class ManufacturingDurations:
+    """Seedable distribution of piece manufacturing times (integer seconds, uniform)."""
+
+    def __init__(self, minimum: int = MACHINE_MIN_DURATION, maximum: int = MACHINE_MAX_DURATION, seed=MACHINE_SEED):
+        self.minimum = minimum
+        self.maximum = maximum
+        self.__random = random.Random(seed)
+
+    def next(self) -> int:
+        """Duration of the next piece."""
+        return self.__random.randint(self.minimum, self.maximum)
+
+
+def create_clock(kind: str = MACHINE_CLOCK):
+    """Clock for the given kind: real or virtual."""
+    if kind == "virtual":
+        return VirtualClock()
+    if kind == "real":
+        return RealClock()
+    raise ValueError(f"Unknown clock {kind}. Use real or virtual")
+
+
+machine_clock = create_clock()
+manufacturing_durations = ManufacturingDurations()
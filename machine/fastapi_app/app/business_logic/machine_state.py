@@ -0,0 +1,76 @@
+# -*- coding: utf-8 -*-
+"""Live state of the machine, published by the machine and read by the status endpoint."""
+import asyncio
+import os
+
+from .clock import machine_clock
+
+THROUGHPUT_EWMA_ALPHA = float(os.getenv("THROUGHPUT_EWMA_ALPHA", "0.2"))
+
+
+class MachineState:
+    """Latest published snapshot of the machine.
+
+    The machine replaces the whole snapshot dict on every change, so readers just take
+    the current reference (no locks, O(1)). Watchers wait on an event that is swapped
+    on every publish.
+    """
+
+    def __init__(self, alpha: float = THROUGHPUT_EWMA_ALPHA):
+        self.alpha = alpha
+        self.started_at = machine_clock.now()
+        self.version = 0
+        self.snapshot = {
+            "status": "Waiting",
+            "working_piece": None,
+            "queue_depth": 0,
+            "workers": [],
+            "pieces_manufactured": 0,
+            "recovery": {"recovering": False, "recovered_pieces": 0}
+        }
+        self.__pieces_per_minute = 0.0
+        self.__last_finished_at = None
+        self.__changed = asyncio.Event()
+
+    def publish(self, snapshot):
+        """Replaces the snapshot and wakes up the watchers."""
+        self.version += 1
+        self.snapshot = snapshot
+        changed, self.__changed = self.__changed, asyncio.Event()
+        changed.set()
+
+    def record_piece_finished(self):
+        """Updates the pieces/min EWMA with the interval since the previous finished piece."""
+        now = machine_clock.now()
+        if self.__last_finished_at is not None and now > self.__last_finished_at:
+            rate = 60 / (now - self.__last_finished_at)
+            self.__pieces_per_minute = self.alpha * rate + (1 - self.alpha) * self.__pieces_per_minute
+        self.__last_finished_at = now
+
+    def current(self):
+        """Current snapshot with uptime and throughput."""
+        now = machine_clock.now()
+        pieces_per_minute = self.__pieces_per_minute
+        if self.__last_finished_at is not None and now > self.__last_finished_at:
+            # Si la máquina lleva tiempo parada, el rate decae
+            pieces_per_minute = min(pieces_per_minute, 60 / (now - self.__last_finished_at))
+        return {
+            **self.snapshot,
+            "version": self.version,
+            "uptime": now - self.started_at,
+            "pieces_per_minute": pieces_per_minute
+        }
+
+    async def wait_for_change(self, version: int = None, timeout: float = 30):
+        """Returns the snapshot once its version differs from *version*, or after *timeout* seconds."""
+        if version is None:
+            version = self.version
+        if self.version == version:
+            try:
+                await asyncio.wait_for(self.__changed.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+        return self.current()
+
+
+machine_state = MachineState()
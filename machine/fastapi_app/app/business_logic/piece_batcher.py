@@ -0,0 +1,67 @@
+# -*- coding: utf-8 -*-
+"""Coalesces finished pieces of the same order into one notification."""
+import asyncio
+import logging
+import os
+
+from .clock import machine_clock
+
+logger = logging.getLogger(__name__)
+
+PIECE_BATCHING = os.getenv("PIECE_BATCHING", "false").lower() == "true"
+PIECE_BATCH_SIZE = int(os.getenv("PIECE_BATCH_SIZE", "10"))
+PIECE_BATCH_MAX_DELAY = float(os.getenv("PIECE_BATCH_MAX_DELAY_MS", "500")) / 1000
+
+
+class PieceBatcher:
+    """Accumulates finished pieces per order for up to *max_delay* seconds or *batch_size* pieces.
+
+    *publish* is a coroutine function called with (order_id, piece_ids) once per batch.
+    add() returns when the batch containing the piece has been published, so the caller
+    can acknowledge its message only after the notification is safe. If the publish fails,
+    add() raises the error in every waiting caller, which must then requeue its message.
+    """
+
+    def __init__(self, publish, batch_size: int = PIECE_BATCH_SIZE, max_delay: float = PIECE_BATCH_MAX_DELAY):
+        self.publish = publish
+        self.batch_size = batch_size
+        self.max_delay = max_delay
+        self.__batches = {}
+
+    async def add(self, order_id, piece_id):
+        """Adds a finished piece to its order batch and waits until the batch is published."""
+        batch = self.__batches.get(order_id)
+        if batch is None:
+            batch = {"pieces": [], "waiters": [], "timer": None}
+            self.__batches[order_id] = batch
+            batch["timer"] = asyncio.create_task(self.__flush_later(order_id, batch))
+        batch["pieces"].append(piece_id)
+        published = asyncio.get_running_loop().create_future()
+        batch["waiters"].append(published)
+        if len(batch["pieces"]) >= self.batch_size:
+            await self.flush(order_id)
+        await published
+
+    async def flush(self, order_id):
+        """Publishes the pending batch of an order."""
+        batch = self.__batches.pop(order_id, None)
+        if batch is None:
+            return
+        if batch["timer"] is not asyncio.current_task():
+            batch["timer"].cancel()
+        try:
+            await self.publish(order_id, batch["pieces"])
+        except Exception as exc:
+            logger.error("Could not publish %i pieces of order %s: %s", len(batch["pieces"]), order_id, exc)
+            for waiter in batch["waiters"]:
+                if not waiter.done():
+                    waiter.set_exception(exc)
+            return
+        for waiter in batch["waiters"]:
+            if not waiter.done():
+                waiter.set_result(None)
+
+    async def __flush_later(self, order_id, batch):
+        await machine_clock.sleep(self.max_delay)
+        if self.__batches.get(order_id) is batch:
+            await self.flush(order_id)
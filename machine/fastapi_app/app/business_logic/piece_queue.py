@@ -0,0 +1,145 @@
+# -*- coding: utf-8 -*-
+"""Manufacturing queue with selectable scheduling policy and O(1) removal by piece id."""
+import asyncio
+import heapq
+import itertools
+import os
+from collections import OrderedDict
+
+from .clock import machine_clock
+
+POLICY_FIFO = "fifo"
+POLICY_ROUND_ROBIN = "round_robin"
+POLICIES = (POLICY_FIFO, POLICY_ROUND_ROBIN)
+
+MACHINE_SCHEDULING_POLICY = os.getenv("MACHINE_SCHEDULING_POLICY", POLICY_FIFO)
+WAIT_STATS_MAX_ORDERS = int(os.getenv("WAIT_STATS_MAX_ORDERS", "1000"))
+
+
+class PieceQueue:
+    """Priority queue of piece ids indexed by piece and by order.
+
+    Pieces are kept in a heap ordered by the policy key:
+    - fifo: arrival order.
+    - round_robin: start-time fair queuing across orders, so a big order does not
+      block the small ones queued after it.
+    Enqueue and dequeue are O(log n). Removal is O(1) (lazy: the heap entry is
+    marked and skipped when it reaches the top).
+    """
+
+    def __init__(self, policy: str = MACHINE_SCHEDULING_POLICY):
+        if policy not in POLICIES:
+            raise ValueError(f"Unknown scheduling policy {policy}. Use one of {POLICIES}")
+        self.policy = policy
+        self.__heap = []
+        self.__entries = {}
+        self.__orders = {}
+        self.__sequence = itertools.count()
+        self.__next_round = {}
+        self.__current_round = 0
+        self.__wait_stats = OrderedDict()
+        self.__not_empty = asyncio.Event()
+
+    def __len__(self):
+        return len(self.__entries)
+
+    def __contains__(self, piece_id):
+        return piece_id in self.__entries
+
+    def empty(self) -> bool:
+        """Return whether the queue has no pieces."""
+        return not self.__entries
+
+    def put_nowait(self, piece_id: int, order_id: int = None):
+        """Adds a piece to the queue. Pieces already queued are ignored."""
+        if piece_id in self.__entries:
+            return
+        sequence = next(self.__sequence)
+        if self.policy == POLICY_ROUND_ROBIN:
+            piece_round = max(self.__next_round.get(order_id, 0), self.__current_round)
+            self.__next_round[order_id] = piece_round + 1
+            priority = piece_round
+        else:
+            priority = 0
+        # [priority, sequence, piece_id, order_id, enqueued_at]; piece_id None means removed
+        entry = [priority, sequence, piece_id, order_id, machine_clock.now()]
+        heapq.heappush(self.__heap, entry)
+        self.__entries[piece_id] = entry
+        self.__orders.setdefault(order_id, set()).add(piece_id)
+        self.__not_empty.set()
+
+    async def put(self, piece_id: int, order_id: int = None):
+        """Adds a piece to the queue."""
+        self.put_nowait(piece_id, order_id)
+
+    def get_nowait(self) -> int:
+        """Removes and returns the next piece id. Raises asyncio.QueueEmpty if empty."""
+        while self.__heap:
+            priority, _, piece_id, order_id, enqueued_at = heapq.heappop(self.__heap)
+            if piece_id is None:
+                continue
+            del self.__entries[piece_id]
+            self.__discard_from_order(piece_id, order_id)
+            if self.policy == POLICY_ROUND_ROBIN:
+                self.__current_round = priority
+            self.__record_wait(order_id, machine_clock.now() - enqueued_at)
+            return piece_id
+        raise asyncio.QueueEmpty
+
+    async def get(self) -> int:
+        """Removes and returns the next piece id, waiting until one is available."""
+        while not self.__entries:
+            self.__not_empty.clear()
+            await self.__not_empty.wait()
+        return self.get_nowait()
+
+    def remove(self, piece_id: int) -> bool:
+        """Removes a piece from the queue in O(1). Returns False if it was not queued."""
+        entry = self.__entries.pop(piece_id, None)
+        if entry is None:
+            return False
+        entry[2] = None
+        self.__discard_from_order(piece_id, entry[3])
+        self.__compact()
+        return True
+
+    def snapshot(self):
+        """Queued piece ids, in the order they will be manufactured."""
+        return [entry[2] for entry in sorted(self.__entries.values())]
+
+    def wait_stats(self):
+        """Per-order wait time statistics (seconds) of the dequeued pieces."""
+        return [
+            {
+                "order_id": order_id,
+                "pieces": stats["pieces"],
+                "mean_wait": stats["total_wait"] / stats["pieces"],
+                "max_wait": stats["max_wait"]
+            }
+            for order_id, stats in self.__wait_stats.items()
+        ]
+
+    def __record_wait(self, order_id, wait):
+        stats = self.__wait_stats.get(order_id)
+        if stats is None:
+            stats = {"pieces": 0, "total_wait": 0.0, "max_wait": 0.0}
+            self.__wait_stats[order_id] = stats
+            while len(self.__wait_stats) > WAIT_STATS_MAX_ORDERS:
+                self.__wait_stats.popitem(last=False)
+        stats["pieces"] += 1
+        stats["total_wait"] += wait
+        stats["max_wait"] = max(stats["max_wait"], wait)
+
+    def __compact(self):
+        # Rebuild the heap when most of it are removed entries
+        if len(self.__heap) > 64 and len(self.__heap) > 2 * len(self.__entries):
+            self.__heap = list(self.__entries.values())
+            heapq.heapify(self.__heap)
+
+    def __discard_from_order(self, piece_id, order_id):
+        order_pieces = self.__orders.get(order_id)
+        if order_pieces is not None:
+            order_pieces.discard(piece_id)
+            if not order_pieces:
+                del self.__orders[order_id]
+                self.__next_round.pop(order_id, None)
@@ -0,0 +1,220 @@
+# -*- coding: utf-8 -*-
+"""Write-ahead journal of the manufacturing queue, for fast recovery after a restart."""
+import asyncio
+import json
+import logging
+import os
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+MACHINE_JOURNAL_DIR = os.getenv("MACHINE_JOURNAL_DIR", "")
+JOURNAL_FLUSH_INTERVAL = float(os.getenv("JOURNAL_FLUSH_INTERVAL_MS", "50")) / 1000
+JOURNAL_FLUSH_SIZE = int(os.getenv("JOURNAL_FLUSH_SIZE", "500"))
+JOURNAL_COMPACT_EVERY = int(os.getenv("JOURNAL_COMPACT_EVERY", "10000"))
+
+OP_ENQUEUE = "enqueue"
+OP_START = "start"
+OP_FINISH = "finish"
+OP_CANCEL = "cancel"
+
+
+class QueueJournal:
+    """Append-only journal of queue operations (enqueue, start, finish, cancel).
+
+    Operations are buffered and written with one fsync per batch (every *flush_interval*
+    seconds or *flush_size* operations). Every *compact_every* operations the live state
+    (queued and started pieces) is written to a snapshot and the journal is truncated, so
+    recovery reads the live queue plus the operations since the last snapshot.
+    Each operation has a sequence number; the snapshot stores the last one it includes.
+    While load() runs, recorded operations are held back and sequenced after the loaded ones.
+    Disabled (every call is a no-op) when *directory* is empty.
+    """
+
+    def __init__(self, directory: str = MACHINE_JOURNAL_DIR, flush_interval: float = JOURNAL_FLUSH_INTERVAL,
+                 flush_size: int = JOURNAL_FLUSH_SIZE, compact_every: int = JOURNAL_COMPACT_EVERY):
+        self.enabled = bool(directory)
+        self.journal_path = os.path.join(directory, "queue.journal")
+        self.snapshot_path = os.path.join(directory, "queue.snapshot")
+        self.flush_interval = flush_interval
+        self.flush_size = flush_size
+        self.compact_every = compact_every
+        self.__sequence = 0
+        self.__operations_since_snapshot = 0
+        self.__buffer = []
+        self.__queued = OrderedDict()  # piece_id -> order_id
+        self.__started = {}  # piece_id -> order_id
+        self.__loading = False
+        self.__held_back = []  # Operations recorded while loading
+        self.__flush_needed = asyncio.Event()
+        self.__write_lock = asyncio.Lock()
+
+    def exists(self) -> bool:
+        """Return whether there is a journal or snapshot to recover from."""
+        return self.enabled and (os.path.exists(self.snapshot_path) or os.path.exists(self.journal_path))
+
+    def begin_load(self):
+        """Holds back record() until load() finishes. Call it before the machine starts working."""
+        self.__loading = True
+
+    async def load(self):
+        """Rebuilds the queue state from the snapshot and the journal.
+
+        The files are read in a thread into a new state, which is installed on the event loop
+        once complete. Returns the started pieces as [(piece_id, order_id)] and the queued
+        pieces as [(piece_id, order_id)], in queue order. If the files cannot be
+        read they are moved aside, the journal restarts empty and the error is raised.
+        """
+        self.__loading = True
+        try:
+            sequence, queued, started, operations = await asyncio.to_thread(self.__read)
+        except (OSError, ValueError, KeyError, TypeError):
+            await asyncio.to_thread(self.__move_aside)
+            self.__install(0, OrderedDict(), {}, 0)
+            raise
+        # Built before installing: the held back operations are already in the live queue
+        recovered = (
+            list(started.items()),
+            list(queued.items())
+        )
+        self.__install(sequence, queued, started, operations)
+        return recovered
+
+    def __install(self, sequence, queued, started, operations):
+        self.__sequence = sequence
+        self.__queued = queued
+        self.__started = started
+        self.__operations_since_snapshot = operations
+        self.__loading = False
+        held_back, self.__held_back = self.__held_back, []
+        for operation in held_back:
+            self.record(*operation)
+
+    def __read(self):
+        sequence = 0
+        operations = 0
+        queued = OrderedDict()
+        started = {}
+        if os.path.exists(self.snapshot_path):
+            with open(self.snapshot_path, "r", encoding="utf-8") as snapshot_file:
+                snapshot = json.load(snapshot_file)
+            sequence = snapshot["sequence"]
+            for piece_id, order_id in snapshot["started"]:
+                started[piece_id] = order_id
+            for piece_id, order_id in snapshot["queued"]:
+                queued[piece_id] = order_id
+        last_sequence = sequence
+        if os.path.exists(self.journal_path):
+            with open(self.journal_path, "r", encoding="utf-8") as journal_file:
+                for line in journal_file:
+                    try:
+                        entry = json.loads(line)
+                    except json.JSONDecodeError:
+                        logger.warning("Truncated journal entry ignored")  # Last write before a crash
+                        break
+                    if entry["seq"] <= last_sequence:
+                        continue
+                    apply_operation(queued, started, entry["op"], entry["piece"], entry.get("order"))
+                    sequence = entry["seq"]
+                    operations += 1
+        return sequence, queued, started, operations
+
+    def __move_aside(self):
+        for path in (self.snapshot_path, self.journal_path):
+            if os.path.exists(path):
+                os.replace(path, path + ".corrupt")
+
+    def record(self, operation, piece_id, order_id=None):
+        """Appends an operation to the journal buffer."""
+        if not self.enabled:
+            return
+        if self.__loading:
+            self.__held_back.append((operation, piece_id, order_id))
+            return
+        self.__sequence += 1
+        apply_operation(self.__queued, self.__started, operation, piece_id, order_id)
+        entry = {"seq": self.__sequence, "op": operation, "piece": piece_id}
+        if order_id is not None:
+            entry["order"] = order_id
+        self.__buffer.append(json.dumps(entry))
+        self.__operations_since_snapshot += 1
+        if len(self.__buffer) >= self.flush_size:
+            self.__flush_needed.set()
+
+    async def run(self):
+        """Coroutine that writes the buffer periodically and compacts the journal."""
+        if not self.enabled:
+            return
+        while True:
+            try:
+                await asyncio.wait_for(self.__flush_needed.wait(), self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self.__flush_needed.clear()
+            try:
+                await self.flush()
+                if self.__operations_since_snapshot >= self.compact_every:
+                    await self.compact()
+            except Exception as exc:
+                logger.error("Error writing the queue journal: %s", exc)
+
+    async def flush(self):
+        """Writes the buffered operations with a single fsync."""
+        async with self.__write_lock:
+            if not self.__buffer:
+                return
+            lines, self.__buffer = self.__buffer, []
+            try:
+                await asyncio.to_thread(self.__append, lines)
+            except Exception:
+                self.__buffer = lines + self.__buffer
+                raise
+
+    async def compact(self):
+        """Writes the live state to the snapshot and truncates the journal."""
+        async with self.__write_lock:
+            snapshot = {
+                "sequence": self.__sequence,
+                "started": list(self.__started.items()),
+                "queued": list(self.__queued.items())
+            }
+            # The buffered operations are newer than the snapshot; they are written after truncating
+            await asyncio.to_thread(self.__write_snapshot, snapshot)
+            self.__operations_since_snapshot = len(self.__buffer)
+        logger.debug("Queue journal compacted at sequence %i", snapshot["sequence"])
+
+    def __append(self, lines):
+        os.makedirs(os.path.dirname(self.journal_path), exist_ok=True)
+        with open(self.journal_path, "a", encoding="utf-8") as journal_file:
+            journal_file.write("\n".join(lines) + "\n")
+            journal_file.flush()
+            os.fsync(journal_file.fileno())
+
+    def __write_snapshot(self, snapshot):
+        os.makedirs(os.path.dirname(self.snapshot_path), exist_ok=True)
+        temporary_path = self.snapshot_path + ".tmp"
+        with open(temporary_path, "w", encoding="utf-8") as snapshot_file:
+            json.dump(snapshot, snapshot_file)
+            snapshot_file.flush()
+            os.fsync(snapshot_file.fileno())
+        os.replace(temporary_path, self.snapshot_path)
+        # Entries up to the snapshot sequence are skipped on load, so a crash here is harmless
+        with open(self.journal_path, "w", encoding="utf-8") as journal_file:
+            journal_file.flush()
+            os.fsync(journal_file.fileno())
+
+
+def apply_operation(queued, started, operation, piece_id, order_id):
+    """Applies a journal operation to a queue state (queued and started dicts)."""
+    if operation == OP_ENQUEUE:
+        if piece_id not in started:
+            queued[piece_id] = order_id
+    elif operation == OP_START:
+        queued.pop(piece_id, None)
+        started[piece_id] = order_id
+    elif operation in (OP_FINISH, OP_CANCEL):
+        queued.pop(piece_id, None)
+        started.pop(piece_id, None)
+
+
+queue_journal = QueueJournal()
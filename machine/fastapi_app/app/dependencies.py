@@ -30,7 +30,7 @@ async def get_machine():
     logger.debug("Getting machine")
     global MY_MACHINE
     if MY_MACHINE is None:
-        from business_logic.async_machine import Machine
+        from app.business_logic.async_machine import Machine
         MY_MACHINE = await Machine.create()
     return MY_MACHINE
 
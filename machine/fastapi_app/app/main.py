@@ -12,6 +12,7 @@ from app.routers import rabbitmq_publish_logs
 import asyncio
 from app.sql import models
 from app.sql import database
+from app.dependencies import get_machine
 import global_variables
 from global_variables.global_variables import update_system_resources_periodically, set_rabbitmq_status, get_rabbitmq_status
 
@@ -70,6 +71,7 @@ async def startup_event():
     await rabbitmq.subscribe_channel()
     await rabbitmq_publish_logs.subscribe_channel()
     asyncio.create_task(rabbitmq.subscribe())
+    await get_machine()
     try:
         task = asyncio.create_task(update_system_resources_periodically(15))
     except Exception as e:
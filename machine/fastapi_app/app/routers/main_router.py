@@ -2,14 +2,16 @@
 """FastAPI router definitions."""
 import logging
 import requests
-from typing import List
-from fastapi import APIRouter, Depends, status, HTTPException
+from typing import List, Optional
+from fastapi import APIRouter, Depends, Query, status, HTTPException
 from sqlalchemy.ext.asyncio import AsyncSession
 from app.business_logic.async_machine import Machine
+from app.business_logic.machine_state import machine_state
 from app.dependencies import get_db, get_machine
 from app.sql import crud
 from app.sql import schemas, models
 from .router_utils import raise_and_log_error
+from app.routers import rabbitmq
 from global_variables.global_variables import rabbitmq_working, system_values
 from global_variables.global_variables import get_rabbitmq_status
 from fastapi.responses import JSONResponse
@@ -81,10 +83,38 @@ async def health_check():
     tags=['Machine']
 )
 async def machine_status(
-        my_machine: Machine = Depends(get_machine)
+        watch: bool = False,
+        version: Optional[int] = None,
+        timeout: float = Query(default=30, gt=0, le=60)
 ):
-    """Retrieve machine status"""
+    """Retrieve machine status. With watch=true, waits until the state changes from *version* (long-poll)."""
     logger.debug("GET '/machine/status' endpoint called.")
-    machine_status = await crud.get_status_of_machine()
-    return machine_status
+    if watch:
+        return await machine_state.wait_for_change(version, timeout)
+    return machine_state.current()
+
+
+@router.get(
+    "/machine/scheduler",
+    summary="Retrieve machine scheduler statistics",
+    response_model=schemas.SchedulerStatusResponse,
+    tags=['Machine']
+)
+async def scheduler_status(
+        my_machine: Machine = Depends(get_machine)
+):
+    """Retrieve scheduling policy and per-order wait times"""
+    logger.debug("GET '/machine/scheduler' endpoint called.")
+    return await my_machine.get_scheduler_stats()
+
 
+@router.get(
+    "/machine/consumer",
+    summary="Retrieve piece consumer status",
+    response_model=schemas.ConsumerStatusResponse,
+    tags=['Machine']
+)
+async def consumer_status():
+    """Retrieve concurrency limit and in-flight pieces of the RabbitMQ consumer"""
+    logger.debug("GET '/machine/consumer' endpoint called.")
+    return rabbitmq.get_consumer_status()
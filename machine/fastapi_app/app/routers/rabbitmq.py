@@ -1,10 +1,14 @@
 import asyncio
+import os
 import aio_pika
 import json
 import logging
 from app.sql import crud
 from app.routers import rabbitmq_publish_logs
+from app.business_logic.clock import machine_clock
+from app.business_logic.piece_batcher import PieceBatcher, PIECE_BATCHING
 import ssl
+import uuid
 import logging
 from global_variables.global_variables import update_system_resources_periodically, set_rabbitmq_status, get_rabbitmq_status
 
@@ -22,6 +26,9 @@ exchange_commands = None
 exchange = None
 exchange_commands_name = 'commands'
 exchange_name = 'exchange'
+PIECE_CONSUMER_CONCURRENCY = int(os.getenv("PIECE_CONSUMER_CONCURRENCY", "10"))
+piece_slots = asyncio.Semaphore(PIECE_CONSUMER_CONCURRENCY)
+in_flight_pieces = set()
 
 async def subscribe_channel():
     """
@@ -72,10 +79,14 @@ async def subscribe_channel():
         raise  # Propaga el error para manejo en niveles superiores
 
 async def on_message(message):
-    async with message.process():
+    # Si falla la publicación el mensaje se devuelve a la cola en vez de perderse
+    async with message.process(requeue=True):
         piece = json.loads(message.body)
-        await crud.set_status_of_machine("Machine Status: Producing")
-        await asyncio.sleep(3)
+        await machine_clock.sleep(3)
+        if PIECE_BATCHING:
+            # El ack del mensaje espera a que se publique el lote de su order
+            await piece_batcher.add(piece['order_id'], piece['piece_id'])
+            return
         data = {
             "id_piece": piece['piece_id'],
             "id_order": piece['order_id']
@@ -91,7 +102,29 @@ async def on_message(message):
         await rabbitmq_publish_logs.publish_log(message_body, routing_key)
 
 
+async def publish_produced_pieces(order_id, piece_ids):
+    """Publishes one events.piece.produced message for a batch of pieces of the same order."""
+    data = {
+        "id_pieces": piece_ids,
+        "id_order": order_id
+    }
+    message_body = json.dumps(data)
+    routing_key = "events.piece.produced"
+    await publish(message_body, routing_key)
+    data = {
+        "message": "INFO - " + str(len(piece_ids)) + " piezas del Order " + str(order_id) + " cambiadas a producido correctamente"
+    }
+    message_body = json.dumps(data)
+    routing_key = "logs.info.machine"
+    await rabbitmq_publish_logs.publish_log(message_body, routing_key)
+
+
+piece_batcher = PieceBatcher(publish_produced_pieces)
+
+
 async def subscribe():
+    # RabbitMQ no entrega más mensajes sin ack que los que se pueden procesar a la vez
+    await channel.set_qos(prefetch_count=PIECE_CONSUMER_CONCURRENCY)
     # Create queue
     queue_name = "events.piece.created"
     queue = await channel.declare_queue(name=queue_name, exclusive=True)
@@ -101,7 +134,28 @@ async def subscribe():
     # Set up a message consumer
     async with queue.iterator() as queue_iter:
         async for message in queue_iter:
-            await on_message(message)
+            await piece_slots.acquire()
+            task = asyncio.create_task(handle_piece_message(message))
+            in_flight_pieces.add(task)
+            task.add_done_callback(in_flight_pieces.discard)
+
+
+async def handle_piece_message(message):
+    """Processes one piece message and frees its concurrency slot."""
+    try:
+        await on_message(message)
+    except Exception as e:
+        logger.error(f"Error procesando la pieza: {e}")
+    finally:
+        piece_slots.release()
+
+
+def get_consumer_status():
+    """Concurrency limit and in-flight messages of the piece consumer."""
+    return {
+        "concurrency": PIECE_CONSUMER_CONCURRENCY,
+        "in_flight": len(in_flight_pieces)
+    }
 
 
 async def publish(message_body, routing_key):
@@ -109,7 +163,8 @@ async def publish(message_body, routing_key):
     await exchange.publish(
         aio_pika.Message(
             body=message_body.encode(),
-            content_type="text/plain"
+            content_type="text/plain",
+            message_id=uuid.uuid4().hex
         ),
         routing_key=routing_key
     )
@@ -4,6 +4,7 @@ import logging
 from datetime import datetime
 from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.future import select
+from sqlalchemy import update, func
 from . import models
 
 logger = logging.getLogger(__name__)
@@ -71,6 +72,20 @@ async def get_piece_list_by_status(db: AsyncSession, status):
     return await get_list_statement_result(db, stmt)
 
 
+async def get_piece_ids_by_status_page(db: AsyncSession, status, after_id=None, limit: int = 500):
+    """Get (id, order_id) of the pieces with a given status, after *after_id*, ordered by id."""
+    stmt = (
+        select(models.Piece.id, models.Piece.order_id)
+        .where(models.Piece.status == status)
+        .order_by(models.Piece.id)
+        .limit(limit)
+    )
+    if after_id is not None:
+        stmt = stmt.where(models.Piece.id > after_id)
+    result = await db.execute(stmt)
+    return result.all()
+
+
 async def update_piece_status(db: AsyncSession, piece_id, status):
     """Persist new piece status on the database."""
     db_piece = await get_element_by_id(db, models.Piece, piece_id)
@@ -91,6 +106,52 @@ async def update_piece_manufacturing_date_to_now(db: AsyncSession, piece_id):
     return db_piece
 
 
+async def start_piece_manufacturing(db: AsyncSession, piece_id):
+    """Sets a piece to manufacturing with a single UPDATE ... RETURNING. Returns the piece as dict."""
+    result = await db.execute(
+        update(models.Piece)
+        .where(models.Piece.id == piece_id)
+        .values(status=models.Piece.STATUS_MANUFACTURING)
+        .returning(*models.Piece.__table__.columns)
+        .execution_options(synchronize_session=False)
+    )
+    piece = result.mappings().first()
+    await db.commit()
+    return dict(piece) if piece else None
+
+
+async def finish_piece_manufacturing(db: AsyncSession, piece_id):
+    """Sets a piece to manufactured (and its manufacturing date) and counts the unfinished pieces
+    of its order, in one transaction.
+
+    Returns the piece as dict (None if it does not exist) and the unfinished pieces of the order.
+    """
+    result = await db.execute(
+        update(models.Piece)
+        .where(models.Piece.id == piece_id)
+        .values(status=models.Piece.STATUS_MANUFACTURED, manufacturing_date=datetime.now())
+        .returning(*models.Piece.__table__.columns)
+        .execution_options(synchronize_session=False)
+    )
+    piece = result.mappings().first()
+    if piece is None:
+        await db.commit()
+        return None, None
+    unfinished_pieces = await count_unfinished_pieces(db, piece['order_id'])
+    await db.commit()
+    return dict(piece), unfinished_pieces
+
+
+async def count_unfinished_pieces(db: AsyncSession, order_id):
+    """Count the pieces of an order that are not manufactured yet, with a single aggregate query."""
+    result = await db.execute(
+        select(func.count(models.Piece.id))
+        .where(models.Piece.order_id == order_id)
+        .where(models.Piece.status != models.Piece.STATUS_MANUFACTURED)
+    )
+    return result.scalar()
+
+
 async def get_piece_list(db: AsyncSession):
     """Load all the orders from the database."""
     stmt = select(models.Piece).join(models.Piece.order)
@@ -143,18 +204,3 @@ async def delete_element_by_id(db: AsyncSession, model, element_id):
         await db.delete(element)
         await db.commit()
     return element
-
-# Machine
-
-
-async def set_status_of_machine(status):
-    global machine_status
-    machine_status = status
-
-async def get_status_of_machine():
-    machine_status = {
-        "message": "Machine Status: Idle",
-        "working_piece": None,  # O el valor real si está disponible
-        "queue": []  # O una lista con los elementos actuales en la cola
-    }
-    return machine_status
@@ -79,6 +79,24 @@ class Piece(PieceBase):
     #    orm_mode = True
 
 
+class MachineWorkerStatus(BaseModel):
+    """machine worker status schema definition."""
+    id: int = Field(description="Worker identifier", example=0)
+    status: str = Field(description="Worker's current status", example="Working")
+    working_piece: Optional[int] = Field(
+        description="Piece id the worker is manufacturing. None if not working piece.",
+        default=None,
+        example=1
+    )
+    pieces_manufactured: int = Field(description="Pieces manufactured by the worker", example=10)
+
+
+class RecoveryStatus(BaseModel):
+    """queue recovery progress schema definition."""
+    recovering: bool = Field(description="Whether the queue is still being recovered", default=False)
+    recovered_pieces: int = Field(description="Pieces recovered into the queue", default=0, example=1500)
+
+
 class MachineStatusResponse(BaseModel):
     """machine status schema definition."""
     status: str = Field(
@@ -90,4 +108,35 @@ class MachineStatusResponse(BaseModel):
         description="Current working piece id. None if not working piece.",
         example=1
     )
-    queue: List[int] = Field(description="Queued piece ids")
+    queue_depth: int = Field(description="Number of queued pieces", default=0, example=5)
+    workers: List[MachineWorkerStatus] = Field(description="State of each worker", default=[])
+    pieces_manufactured: int = Field(description="Pieces manufactured since start", default=0, example=10)
+    pieces_per_minute: float = Field(
+        description="Exponentially weighted moving average of manufactured pieces per minute",
+        default=0.0,
+        example=40.0
+    )
+    uptime: float = Field(description="Seconds since the machine started", default=0.0, example=3600.0)
+    version: int = Field(description="Snapshot version, to be used with watch=true", default=0, example=42)
+    recovery: RecoveryStatus = Field(description="Progress of the queue recovery at startup", default=RecoveryStatus())
+
+
+class ConsumerStatusResponse(BaseModel):
+    """piece consumer status schema definition."""
+    concurrency: int = Field(description="Maximum pieces processed at the same time", example=10)
+    in_flight: int = Field(description="Pieces being processed right now", example=3)
+
+
+class OrderWaitStats(BaseModel):
+    """per-order queue wait time schema definition."""
+    order_id: Optional[int] = Field(description="Order identifier", example=1)
+    pieces: int = Field(description="Pieces of the order taken from the queue", example=10)
+    mean_wait: float = Field(description="Mean seconds a piece waited in the queue", example=12.5)
+    max_wait: float = Field(description="Maximum seconds a piece waited in the queue", example=30.1)
+
+
+class SchedulerStatusResponse(BaseModel):
+    """machine scheduler status schema definition."""
+    policy: str = Field(description="Scheduling policy: fifo or round_robin", example="round_robin")
+    queued_pieces: int = Field(description="Pieces waiting in the queue", example=100)
+    orders: List[OrderWaitStats] = Field(description="Wait time statistics per order")
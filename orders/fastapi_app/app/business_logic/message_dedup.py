@@ -0,0 +1,82 @@
+# -*- coding: utf-8 -*-
+"""Idempotent consumer store: remembers which RabbitMQ messages have already been processed."""
+import asyncio
+import hashlib
+import logging
+import os
+from collections import OrderedDict
+from datetime import datetime, timedelta
+
+from app.sql import crud
+from app.sql.database import SessionLocal
+
+logger = logging.getLogger(__name__)
+
+PROCESSED_MESSAGES_CACHE_SIZE = int(os.getenv("PROCESSED_MESSAGES_CACHE_SIZE", "10000"))
+# Redeliveries older than this are not expected; their keys are pruned from the table
+PROCESSED_MESSAGES_TTL = float(os.getenv("PROCESSED_MESSAGES_TTL_HOURS", "168")) * 3600
+PROCESSED_MESSAGES_PRUNE_INTERVAL = float(os.getenv("PROCESSED_MESSAGES_PRUNE_INTERVAL_S", "3600"))
+
+
+def message_key(message, business_key):
+    """Key of a message: its message id if the publisher set one, (routing key, business key) otherwise.
+
+    Long business keys (e.g. batches of pieces) are hashed to fit in the table.
+    """
+    if message.message_id:
+        return str(message.message_id)
+    key = f"{message.routing_key}:{business_key}"
+    if len(key) > 256:
+        key = f"{message.routing_key}:{hashlib.sha256(str(business_key).encode()).hexdigest()}"
+    return key
+
+
+def is_duplicate_message(exc) -> bool:
+    """Return whether an IntegrityError is the processed_message key of a duplicate message.
+
+    Any other constraint violation of the consumer transaction is a real error.
+    """
+    return "processed_message" in str(getattr(exc, "orig", exc))
+
+
+class ProcessedMessages:
+    """Bounded in-memory LRU of recently processed message keys.
+
+    It only skips the common duplicates without opening a transaction. The processed_message
+    table is the source of truth: consumers add the key in the same transaction as their
+    writes, so a duplicate that is not in memory fails its commit with IntegrityError.
+    run() prunes the table keys older than the redelivery horizon.
+    """
+
+    def __init__(self, max_size: int = PROCESSED_MESSAGES_CACHE_SIZE):
+        self.max_size = max_size
+        self.__keys = OrderedDict()
+
+    def seen(self, key) -> bool:
+        """Return whether the message is known to be processed already."""
+        if key in self.__keys:
+            self.__keys.move_to_end(key)
+            return True
+        return False
+
+    def remember(self, key):
+        """Remembers a message key after its transaction has been committed."""
+        self.__keys[key] = None
+        self.__keys.move_to_end(key)
+        while len(self.__keys) > self.max_size:
+            self.__keys.popitem(last=False)
+
+    async def run(self, ttl: float = PROCESSED_MESSAGES_TTL, interval: float = PROCESSED_MESSAGES_PRUNE_INTERVAL):
+        """Coroutine that periodically deletes the processed message keys older than *ttl* seconds."""
+        while True:
+            try:
+                async with SessionLocal() as db:
+                    pruned = await crud.delete_processed_messages_before(db, datetime.utcnow() - timedelta(seconds=ttl))
+                if pruned:
+                    logger.info("%i processed message keys pruned", pruned)
+            except Exception as exc:
+                logger.error("Error pruning processed messages: %s", exc)
+            await asyncio.sleep(interval)
+
+
+processed_messages = ProcessedMessages()
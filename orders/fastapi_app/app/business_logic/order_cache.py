@@ -0,0 +1,81 @@
+# -*- coding: utf-8 -*-
+"""In-process LRU/TTL cache of serialized orders."""
+import logging
+import os
+import time
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+ORDER_CACHE_SIZE = int(os.getenv("ORDER_CACHE_SIZE", "1024"))
+ORDER_CACHE_TTL = float(os.getenv("ORDER_CACHE_TTL", "30"))
+
+
+class OrderCache:
+    """LRU cache with expiration, invalidated by the service's own writes.
+
+    A fill is dropped only if its own order was invalidated after the fill read the
+    database, so writes to other orders do not prevent caching. The invalidation times
+    of the last *max_size* * 4 invalidated orders are kept; older fills are dropped
+    conservatively.
+    """
+
+    def __init__(self, max_size: int = ORDER_CACHE_SIZE, ttl: float = ORDER_CACHE_TTL):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.__entries = OrderedDict()
+        self.__generation = 0
+        self.__invalidated_at = OrderedDict()  # order_id -> generation of its last invalidation
+        self.__forgotten_before = 0  # Latest generation evicted from __invalidated_at
+
+    @property
+    def generation(self) -> int:
+        """Invalidation clock. Read it before loading a value from the database."""
+        return self.__generation
+
+    def get(self, order_id):
+        """Returns the cached order or None, updating hit/miss counters."""
+        entry = self.__entries.get(order_id)
+        if entry is None or entry[0] < time.monotonic():
+            if entry is not None:
+                del self.__entries[order_id]
+            self.misses += 1
+            return None
+        self.__entries.move_to_end(order_id)
+        self.hits += 1
+        return entry[1]
+
+    def put(self, order_id, value, generation: int):
+        """Stores a value unless an invalidation happened since *generation* was read."""
+        if self.max_size <= 0 or generation < self.__invalidated_at.get(order_id, self.__forgotten_before):
+            return
+        self.__entries[order_id] = (time.monotonic() + self.ttl, value)
+        self.__entries.move_to_end(order_id)
+        while len(self.__entries) > self.max_size:
+            self.__entries.popitem(last=False)
+
+    def invalidate(self, order_id):
+        """Removes an order from the cache."""
+        self.__generation += 1
+        self.__entries.pop(order_id, None)
+        self.__invalidated_at[order_id] = self.__generation
+        self.__invalidated_at.move_to_end(order_id)
+        while len(self.__invalidated_at) > max(self.max_size, 1) * 4:
+            _, self.__forgotten_before = self.__invalidated_at.popitem(last=False)
+
+    def stats(self):
+        """Return the cache counters as dict."""
+        lookups = self.hits + self.misses
+        return {
+            "size": len(self.__entries),
+            "max_size": self.max_size,
+            "ttl": self.ttl,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": self.hits / lookups if lookups else 0.0
+        }
+
+
+order_cache = OrderCache()
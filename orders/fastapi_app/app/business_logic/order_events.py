@@ -0,0 +1,46 @@
+# -*- coding: utf-8 -*-
+"""In-process pub/sub hub of order status changes."""
+import asyncio
+import logging
+import os
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+ORDER_EVENTS_QUEUE_SIZE = int(os.getenv("ORDER_EVENTS_QUEUE_SIZE", "100"))
+
+
+class OrderEventHub:
+    """Fans out order events to the subscribers of each order."""
+
+    def __init__(self, queue_size: int = ORDER_EVENTS_QUEUE_SIZE):
+        self.queue_size = queue_size
+        self.__subscribers = {}
+
+    @contextmanager
+    def subscribe(self, order_id):
+        """Registers a subscriber queue for the given order while the context is open."""
+        queue = asyncio.Queue(maxsize=self.queue_size)
+        self.__subscribers.setdefault(order_id, set()).add(queue)
+        try:
+            yield queue
+        finally:
+            subscribers = self.__subscribers.get(order_id)
+            if subscribers is not None:
+                subscribers.discard(queue)
+                if not subscribers:
+                    del self.__subscribers[order_id]
+
+    def publish(self, order_id, event_type, data):
+        """Sends an event to every subscriber of the order. Slow subscribers lose their oldest events."""
+        subscribers = self.__subscribers.get(order_id)
+        if not subscribers:
+            return
+        event = (event_type, data)
+        for queue in subscribers:
+            if queue.full():
+                queue.get_nowait()
+            queue.put_nowait(event)
+
+
+order_events = OrderEventHub()
@@ -0,0 +1,70 @@
+# -*- coding: utf-8 -*-
+"""Batching writer for the sagas history."""
+import asyncio
+import logging
+import os
+
+from app.sql import crud
+from app.sql.database import SessionLocal
+from app.business_logic.order_events import order_events
+
+logger = logging.getLogger(__name__)
+
+SAGAS_BATCH_SIZE = int(os.getenv("SAGAS_BATCH_SIZE", "100"))
+SAGAS_FLUSH_INTERVAL = float(os.getenv("SAGAS_FLUSH_INTERVAL_MS", "200")) / 1000
+
+
+class SagasHistoryWriter:
+    """Buffers sagas history records and writes them every *batch_size* records or *flush_interval* seconds."""
+
+    def __init__(self, batch_size: int = SAGAS_BATCH_SIZE, flush_interval: float = SAGAS_FLUSH_INTERVAL):
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.__pending = []
+        self.__batch_ready = asyncio.Event()
+        self.__flush_lock = asyncio.Lock()
+
+    def append(self, id_order, status):
+        """Queues a sagas history record. It is persisted by the next flush."""
+        self.__pending.append({"id_order": id_order, "status": status})
+        order_events.publish(id_order, "saga", {"id_order": id_order, "status": status})
+        if len(self.__pending) >= self.batch_size:
+            self.__batch_ready.set()
+
+    def has_pending(self, id_order=None) -> bool:
+        """Return whether there are records (of the given order) waiting to be written."""
+        if id_order is None:
+            return bool(self.__pending)
+        return any(record["id_order"] == id_order for record in self.__pending)
+
+    async def flush(self) -> int:
+        """Writes all the pending records in a single insert."""
+        async with self.__flush_lock:
+            if not self.__pending:
+                return 0
+            records, self.__pending = self.__pending, []
+            try:
+                async with SessionLocal() as db:
+                    await crud.add_sagas_history_batch(db, records)
+            except Exception:
+                # Se vuelven a encolar para el siguiente flush
+                self.__pending = records + self.__pending
+                raise
+            logger.debug("%i sagas history records written", len(records))
+            return len(records)
+
+    async def run(self):
+        """Coroutine that flushes the buffer periodically or when a batch is full."""
+        while True:
+            try:
+                await asyncio.wait_for(self.__batch_ready.wait(), self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self.__batch_ready.clear()
+            try:
+                await self.flush()
+            except Exception as e:
+                logger.error(f"Error escribiendo el historial de sagas: {e}")
+
+
+sagas_writer = SagasHistoryWriter()
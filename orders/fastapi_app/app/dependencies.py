@@ -1,12 +1,16 @@
 # -*- coding: utf-8 -*-
 """Application dependency injector."""
 import logging
+import os
 
-import logging
+import httpx
 
 logger = logging.getLogger(__name__)
 
 MY_MACHINE = None
+HTTP_CLIENT = None
+HTTP_TIMEOUT = float(os.getenv("HTTP_TIMEOUT", "5"))
+HTTP_MAX_CONNECTIONS = int(os.getenv("HTTP_MAX_CONNECTIONS", "100"))
 
 
 # Database #########################################################################################
@@ -37,5 +41,25 @@ async def get_machine():
     return MY_MACHINE
 
 
+# HTTP client #####################################################################################
+async def get_http_client():
+    """Returns the shared pooled HTTP client (creates it the first time its executed)."""
+    global HTTP_CLIENT
+    if HTTP_CLIENT is None:
+        HTTP_CLIENT = httpx.AsyncClient(
+            timeout=httpx.Timeout(HTTP_TIMEOUT, connect=min(HTTP_TIMEOUT, 2.0)),
+            limits=httpx.Limits(max_connections=HTTP_MAX_CONNECTIONS, max_keepalive_connections=20)
+        )
+    return HTTP_CLIENT
+
+
+async def close_http_client():
+    """Closes the shared HTTP client and its pooled connections."""
+    global HTTP_CLIENT
+    if HTTP_CLIENT is not None:
+        await HTTP_CLIENT.aclose()
+        HTTP_CLIENT = None
+
+
 # asyncio.create_task(get_machine())
 # asyncio.run(init_machine())
\ No newline at end of file
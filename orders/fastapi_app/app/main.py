@@ -7,8 +7,12 @@ import json
 from contextlib import asynccontextmanager
 
 from fastapi import FastAPI
-from app.routers import main_router, rabbitmq, rabbitmq_publish_logs
+from app.routers import main_router, rabbitmq, rabbitmq_publish_logs, rabbitmq_outbox
 from app.sql import models
+from app.sql import crud
+from app.dependencies import close_http_client
+from app.business_logic.sagas_writer import sagas_writer
+from app.business_logic.message_dedup import processed_messages
 from app.sql import database
 import global_variables
 from global_variables.global_variables import update_system_resources_periodically, set_rabbitmq_status, get_rabbitmq_status
@@ -69,6 +73,13 @@ async def startup_event():
     logger.info("Creating database tables")
     async with database.engine.begin() as conn:
         await conn.run_sync(models.Base.metadata.create_all)
+        backfill_needed = await conn.run_sync(crud.add_pieces_remaining_column)
+        await conn.run_sync(crud.add_outbox_message_id_column)
+        await conn.run_sync(crud.create_missing_indexes)
+    if backfill_needed:
+        logger.info("Backfilling pieces_remaining of existing orders")
+        async with database.SessionLocal() as db:
+            await crud.backfill_pieces_remaining(db)
     await rabbitmq.subscribe_channel()
     await rabbitmq_publish_logs.subscribe_channel()
     logger.info("Se ha suscrito")
@@ -77,6 +88,9 @@ async def startup_event():
     asyncio.create_task(rabbitmq.subscribe_payment_checked())
     asyncio.create_task(rabbitmq.subscribe_delivery_cancel())
     asyncio.create_task(rabbitmq.subscribe_order_finished())
+    asyncio.create_task(rabbitmq_outbox.relay_outbox())
+    asyncio.create_task(sagas_writer.run())
+    asyncio.create_task(processed_messages.run())
     try:
         task = asyncio.create_task(update_system_resources_periodically(15))
     except Exception as e:
@@ -90,6 +104,12 @@ async def startup_event():
     await rabbitmq_publish_logs.publish_log(message_body, routing_key)
     logger.info("Se ha enviado")
 
+@app.on_event("shutdown")
+async def shutdown_event():
+    """Configuration to be executed when FastAPI server stops."""
+    await sagas_writer.flush()
+    await close_http_client()
+
 if __name__ == "__main__":
     import uvicorn
 
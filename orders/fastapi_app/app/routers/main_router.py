@@ -2,23 +2,28 @@
 """FastAPI router definitions."""
 import logging
 import json
+import os
 import httpx
-import requests
-from typing import List
-from fastapi import APIRouter, Depends, status, HTTPException
+from typing import List, Optional
+import asyncio
+from fastapi import APIRouter, Depends, Query, Request, status, HTTPException
 from fastapi.security import HTTPAuthorizationCredentials, HTTPBearer, OAuth2PasswordBearer
 from jose import JWTError, jwt
 from pydantic.json_schema import models_json_schema
 from sqlalchemy.ext.asyncio import AsyncSession
-from app.dependencies import get_db, get_machine
+from app.dependencies import get_db, get_machine, get_http_client
+from app.business_logic.order_cache import order_cache
+from app.business_logic.sagas_writer import sagas_writer
+from app.business_logic.order_events import order_events
 from app.sql import crud
 from ..sql import schemas
-from app.routers import rabbitmq_publish_logs, rabbitmq
+from app.routers import rabbitmq_publish_logs, rabbitmq, rabbitmq_outbox
 from .router_utils import raise_and_log_error
 from typing import Dict
 from global_variables.global_variables import rabbitmq_working, system_values
 from global_variables.global_variables import get_rabbitmq_status
-from fastapi.responses import JSONResponse
+from fastapi.responses import JSONResponse, StreamingResponse
+from app.sql.database import SessionLocal
 
 with open("/keys/priv.pem", "r") as priv_file:
     PRIVATE_KEY = priv_file.read()
@@ -34,6 +39,8 @@ router = APIRouter()
 
 
 ALGORITHM = "RS256"
+SSE_KEEPALIVE_INTERVAL = float(os.getenv("SSE_KEEPALIVE_INTERVAL", "15"))
+MACHINE_URL = os.getenv("MACHINE_URL", "http://localhost:8001")
 
 def verify_access_token(token: str):
     """Verifica la validez del token JWT"""
@@ -164,19 +171,92 @@ async def create_order(
     logger.debug("POST '/order' endpoint called.")
     order_schema.id_client=current_user["user_id"]
     db_order = await crud.create_order_from_schema(db, order_schema)
-    data = {
-        "id_order": db_order.id,
-        "id_client": db_order.id_client,
-        "movement": -(db_order.number_of_pieces)
-    }
-    message_body = json.dumps(data)
-    routing_key = "events.order.created.pending"
-    await rabbitmq.publish(message_body, routing_key)
-    await rabbitmq_publish_logs.publish_log("order " + str(db_order.id) + " needs the balance to be checked", "logs.info.order")
+    # Los mensajes se publican desde el outbox, sin esperar a RabbitMQ
+    rabbitmq_outbox.notify()
 
     # Retornar la respuesta final
     return {"detail": "Order created successfully", "order_id": db_order.id}
 
+@router.post(
+    "/create_orders",
+    summary="Create many orders",
+    response_model=List[schemas.OrderBulkResult],
+    status_code=status.HTTP_201_CREATED,
+    tags=["Order"]
+)
+async def create_orders(
+    order_schemas: List[schemas.OrderPost],
+    current_user: dict = Depends(get_current_user),
+    db: AsyncSession = Depends(get_db),
+):
+    """Create many orders in a single transaction. Returns the id or the error of each order."""
+    logger.debug("POST '/create_orders' endpoint called with %i orders.", len(order_schemas))
+    results = [schemas.OrderBulkResult(index=index) for index in range(len(order_schemas))]
+    valid_orders = []
+    for result, order_schema in zip(results, order_schemas):
+        if order_schema.number_of_pieces is None or order_schema.number_of_pieces <= 0:
+            result.error = "number_of_pieces must be greater than 0"
+            continue
+        order_schema.id_client = current_user["user_id"]
+        valid_orders.append((result, order_schema))
+
+    if valid_orders:
+        db_orders = await crud.create_orders_from_schemas(db, [order for _, order in valid_orders])
+        for (result, _), db_order in zip(valid_orders, db_orders):
+            result.order_id = db_order.id
+        # Los mensajes de todos los orders se publican desde el outbox por lotes
+        rabbitmq_outbox.notify()
+
+    return results
+
+
+@router.get(
+    "/orders",
+    summary="Retrieve a page of orders",
+    response_model=schemas.OrderPage,
+    tags=['Order']
+)
+async def get_orders_page(
+        after_id: Optional[int] = None,
+        limit: int = Query(default=50, ge=1, le=500),
+        order_status: Optional[str] = Query(default=None, alias="status"),
+        id_client: Optional[int] = None,
+        db: AsyncSession = Depends(get_db),
+        current_user: Dict = Depends(get_current_user)
+):
+    """Retrieve orders with keyset pagination. Use next_after_id to get the next page."""
+    logger.debug("GET '/orders' endpoint called.")
+    if current_user.get("role") != "admin":
+        id_client = current_user["user_id"]
+    orders = await crud.get_order_page(db, limit, after_id, order_status, id_client)
+    next_after_id = orders[-1].id if len(orders) == limit else None
+    return {"orders": orders, "next_after_id": next_after_id}
+
+
+@router.get(
+    "/orders/export",
+    summary="Export orders as NDJSON",
+    tags=['Order']
+)
+async def export_orders(
+        order_status: Optional[str] = Query(default=None, alias="status"),
+        id_client: Optional[int] = None,
+        current_user: Dict = Depends(get_current_user)
+):
+    """Stream all the matching orders, one JSON document per line."""
+    logger.debug("GET '/orders/export' endpoint called.")
+    if current_user.get("role") != "admin":
+        id_client = current_user["user_id"]
+
+    async def order_lines():
+        # La sesión se abre aquí porque get_db se cierra antes de enviar la respuesta
+        async with SessionLocal() as db:
+            async for order in crud.stream_orders(db, order_status, id_client):
+                yield schemas.Order.model_validate(order).model_dump_json() + "\n"
+
+    return StreamingResponse(order_lines(), media_type="application/x-ndjson")
+
+
 @router.get(
     "/order/{order_id}",
     summary="Retrieve single order by id",
@@ -198,16 +278,65 @@ async def get_single_order(
 ):
     """Retrieve single order by id"""
     logger.debug("GET '/order/%i' endpoint called.", order_id)
-    order = await crud.get_order(db, order_id)
     data = {
         "message": "INFO - Order obtained by id"
     }
     message_body = json.dumps(data)
     routing_key = "logs.info.order"
-    await rabbitmq_publish_logs.publish_log(message_body, routing_key)
+    rabbitmq_publish_logs.publish_log_nowait(message_body, routing_key)
+    cached_order = order_cache.get(order_id)
+    if cached_order is not None:
+        return cached_order
+    generation = order_cache.generation
+    order = await crud.get_order(db, order_id)
     if not order:
         raise_and_log_error(logger, status.HTTP_404_NOT_FOUND, f"Order {order_id} not found")
-    return order
+    order_json = schemas.Order.model_validate(order).model_dump(mode="json")
+    order_cache.put(order_id, order_json, generation)
+    return order_json
+
+
+@router.get(
+    "/order_cache/stats",
+    summary="Retrieve order cache statistics",
+    tags=['Order']
+)
+async def get_order_cache_stats(
+        current_user: Dict = Depends(get_current_user)
+):
+    """Retrieve hit/miss counters of the order cache"""
+    logger.debug("GET '/order_cache/stats' endpoint called.")
+    return order_cache.stats()
+
+
+@router.get(
+    "/order/{order_id}/events",
+    summary="Stream status changes of an order (server-sent events)",
+    tags=['Order']
+)
+async def stream_order_events(
+        order_id: int,
+        request: Request,
+        current_user: Dict = Depends(get_current_user)
+):
+    """Stream the status, saga and piece events of an order while the connection is open."""
+    logger.debug("GET '/order/%i/events' endpoint called.", order_id)
+
+    async def event_stream():
+        with order_events.subscribe(order_id) as queue:
+            while not await request.is_disconnected():
+                try:
+                    event_type, data = await asyncio.wait_for(queue.get(), SSE_KEEPALIVE_INTERVAL)
+                except asyncio.TimeoutError:
+                    yield ": keepalive\n\n"
+                    continue
+                yield f"event: {event_type}\ndata: {json.dumps(data)}\n\n"
+
+    return StreamingResponse(
+        event_stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
 
 
 @router.delete(
@@ -227,7 +356,8 @@ async def get_single_order(
 async def remove_order_by_id(
         order_id: int,
         db: AsyncSession = Depends(get_db),
-current_user: Dict = Depends(get_current_user)
+        current_user: Dict = Depends(get_current_user),
+        http_client: httpx.AsyncClient = Depends(get_http_client)
         #my_machine: Machine = Depends(get_machine)
 ):
     """Remove order"""
@@ -252,7 +382,7 @@ current_user: Dict = Depends(get_current_user)
         raise_and_log_error(logger, status.HTTP_404_NOT_FOUND, f"Order {order_id} not found")
     #await my_machine.remove_pieces_from_queue(order.pieces)
     try:
-        response= requests.delete(f"http://localhost:8001/machine_order/{order_id}")
+        response = await http_client.delete(f"{MACHINE_URL}/machine_order/{order_id}")
         if response.status_code != status.HTTP_200_OK:
             raise Exception
         return await crud.delete_order(db, order_id)
@@ -327,6 +457,8 @@ async def get_sagas_history(
 ):
     """Retrieve sagas history"""
     logger.debug("GET '/order/sagashistory/%i' endpoint called.", order_id)
+    if sagas_writer.has_pending(order_id):
+        await sagas_writer.flush()
     logs = await crud.get_sagas_history(db, order_id)
     if not logs:
         data = {
@@ -1,11 +1,17 @@
+import asyncio
 import aio_pika
 import json
 from app.sql.database import SessionLocal  # pylint: disable=import-outside-toplevel
 from app.sql import crud
 from app.sql import models, schemas
 import logging
-from app.routers import rabbitmq_publish_logs
+from app.routers import rabbitmq_publish_logs, rabbitmq_outbox
+from app.routers.rabbitmq_exchanges import exchange_commands_name, exchange_name, exchange_responses_name
+from app.business_logic.sagas_writer import sagas_writer
+from app.business_logic.message_dedup import processed_messages, message_key, is_duplicate_message
 import ssl
+import uuid
+from sqlalchemy.exc import IntegrityError
 from global_variables.global_variables import update_system_resources_periodically, set_rabbitmq_status, get_rabbitmq_status
 
 # Configura el logger
@@ -21,9 +27,6 @@ ssl_context.verify_mode = ssl.CERT_NONE  # No verifica el certificado del servid
 channel = None
 exchange_commands = None
 exchange = None
-exchange_commands_name = 'commands'
-exchange_name = 'exchange'
-exchange_responses_name = 'responses'
 exchange_responses = None
 
 async def subscribe_channel():
@@ -80,34 +83,50 @@ async def subscribe_channel():
 async def on_piece_message(message):
     async with message.process():
         piece_recieve = json.loads(message.body)
-        db = SessionLocal()
-        db_order = await crud.get_order(db, piece_recieve['id_order'])
-        db_piece = await crud.update_piece_status(db, piece_recieve['id_piece'], models.Piece.STATUS_CREATED)
-        db_pieces = await crud.get_piece_list_by_order(db, db_order.id)
-        order_finished = True
-        logger.info("esta llegando la pieza terminada " + str(piece_recieve['id_piece']) + " a order " + str(db_order.id))
-        for piece in db_pieces:
-            if piece.status == models.Piece.STATUS_QUEUED:
-                order_finished = False
-                break
-        if order_finished:
-            db_order = await crud.update_order_status(db, piece_recieve['id_order'], models.Order.STATUS_FINISHED)
-            data = {
-                "id_order": piece_recieve['id_order']
-            }
-            message_body = json.dumps(data)
-            routing_key = "events.order.produced"
-            await publish(message_body, routing_key)
+        # Los mensajes agrupados de machine traen "id_pieces" en vez de "id_piece"
+        piece_ids = piece_recieve.get('id_pieces') or [piece_recieve['id_piece']]
+        key = message_key(message, ",".join(str(piece_id) for piece_id in piece_ids))
+        if processed_messages.seen(key):
+            logger.info("Mensaje duplicado ignorado: " + key)
+            return
+        logger.info("estan llegando " + str(len(piece_ids)) + " piezas terminadas a order " + str(piece_recieve['id_order']))
+        try:
+            async with SessionLocal() as db:
+                # Piezas, order terminado, events.order.produced y clave del mensaje en una transacción
+                remaining = await crud.mark_pieces_produced(db, piece_recieve['id_order'], piece_ids, key)
+        except IntegrityError as exc:
+            if not is_duplicate_message(exc):
+                raise
+            logger.info("Mensaje duplicado ignorado: " + key)
+            processed_messages.remember(key)
+            return
+        processed_messages.remember(key)
+        if remaining == 0:
+            rabbitmq_outbox.notify()
             await rabbitmq_publish_logs.publish_log("Todas las piezas del order producidas", "logs.info.order")
-        await db.close()
+
 
 async def on_order_delivered_message(message):
     async with message.process():
         order = json.loads(message.body)
-        db = SessionLocal()
-        db_order = await crud.update_order_status(db, order['id'], models.Order.STATUS_DELIVERED)
-        await rabbitmq_publish_logs.publish_log("order " + order['id'] + "delivered", "logs.info.order")
-        await db.close()
+        # Los repartos agrupados de delivery traen "id_orders" en vez de "id"
+        order_ids = order.get('id_orders') or [order['id']]
+        key = message_key(message, ",".join(str(order_id) for order_id in order_ids))
+        if processed_messages.seen(key):
+            logger.info("Mensaje duplicado ignorado: " + key)
+            return
+        try:
+            async with SessionLocal() as db:
+                await crud.update_orders_status(db, order_ids, models.Order.STATUS_DELIVERED, key)
+        except IntegrityError as exc:
+            if not is_duplicate_message(exc):
+                raise
+            logger.info("Mensaje duplicado ignorado: " + key)
+            processed_messages.remember(key)
+            return
+        processed_messages.remember(key)
+        await rabbitmq_publish_logs.publish_log("orders " + str(order_ids) + " delivered", "logs.info.order")
+
 
 async def subscribe_pieces():
     # Create a queue
@@ -137,47 +156,43 @@ async def subscribe_order_finished():
 async def on_payment_checked_message(message):
     async with message.process():
         payment = json.loads(message.body)
-        db = SessionLocal()
-        db_saga = SessionLocal()
+        key = message_key(message, payment['id_order'])
+        if processed_messages.seen(key):
+            logger.info("Mensaje duplicado ignorado: " + key)
+            return
+        try:
+            async with SessionLocal() as db:
+                if payment['status']:
+                    # Estado, piezas, sus eventos y la clave del mensaje en una sola transacción
+                    db_order, piece_ids = await crud.pay_order(db, payment['id_order'], key)
+                else:
+                    data = {
+                        "order_id": payment['id_order']
+                    }
+                    crud.add_outbox_message(db, exchange_commands_name, "delivery.cancel", json.dumps(data))
+                    db_order = await crud.update_order_status(db, payment['id_order'], models.Order.STATUS_PAYMENT_DONE, key)
+        except IntegrityError as exc:
+            if not is_duplicate_message(exc):
+                raise
+            logger.info("Mensaje duplicado ignorado: " + key)
+            processed_messages.remember(key)
+            return
+        processed_messages.remember(key)
+        rabbitmq_outbox.notify()
+        if db_order is None:
+            logger.warning("Order %s not found", payment['id_order'])
+            return
         if payment['status']:
-            db_order = await crud.update_order_status(db, payment['id_order'], models.Order.STATUS_PAYMENT_DONE)
-            await crud.create_sagas_history(db_saga, payment['id_order'], models.Order.STATUS_PAYMENT_DONE)
-            data = {
-                "id_order": db_order.id,
-                "user_id": db_order.id_client
-            }
-            message_body = json.dumps(data)
-            routing_key = "events.order.created"
-            await publish(message_body, routing_key)
+            sagas_writer.append(payment['id_order'], models.Order.STATUS_PAYMENT_DONE)
             await rabbitmq_publish_logs.publish_log("El order ha sido pagado por el cliente " + str(db_order.id_client), "logs.info.order")
-
-            # Crear las piezas de la orden
-            for _ in range(db_order.number_of_pieces):
-                db_piece = await crud.add_piece_to_order(db, db_order)
-                data = {
-                    "piece_id": db_piece.id,
-                    "order_id": db_order.id
-                }
-                logger.info("pieza "+str(db_piece.id)+" creada para order "+str(db_order.id))
-                message_body = json.dumps(data)
-                routing_key = "events.piece.created"
-                await publish(message_body, routing_key)
-                await rabbitmq_publish_logs.publish_log("Petición de hacer pieza enviada", "logs.info.order")
-
-            # pydantic_order = schemas.Order.from_orm(db_order)
-            # order_json = pydantic_order.dict()
+            logger.info(str(len(piece_ids)) + " piezas creadas para order " + str(db_order.id))
+            await rabbitmq_publish_logs.publish_log(
+                str(len(piece_ids)) + " peticiones de hacer pieza enviadas para el order " + str(db_order.id),
+                "logs.info.order"
+            )
         else:
-            db_order = await crud.update_order_status(db, payment['id_order'], models.Order.STATUS_PAYMENT_DONE)
             await rabbitmq_publish_logs.publish_log("El balance no es suficiente para el cliente " + str(payment["id_client"]), "logs.error.order")
-            await crud.create_sagas_history(db_saga, payment['id_order'], models.Order.STATUS_PAYMENT_CANCELED)
-            data = {
-                "order_id": db_order.id
-            }
-            message_body = json.dumps(data)
-            routing_key = "delivery.cancel"
-            await publish_command(message_body, routing_key)
-        await db.close()
-        await db_saga.close()
+            sagas_writer.append(payment['id_order'], models.Order.STATUS_PAYMENT_CANCELED)
 
 
 async def subscribe_delivery_cancel():
@@ -223,10 +238,9 @@ async def on_delivery_checked_message(message):
     async with message.process():
         delivery = json.loads(message.body)
         db = SessionLocal()
-        db_saga = SessionLocal()
         if delivery['status'] == True:
             db_order = await crud.update_order_status(db, delivery['order_id'], models.Order.STATUS_PAYMENT_PENDING)
-            await crud.create_sagas_history(db_saga, delivery['order_id'], models.Order.STATUS_PAYMENT_PENDING)
+            sagas_writer.append(delivery['order_id'], models.Order.STATUS_PAYMENT_PENDING)
             data = {
                 "id_order": db_order.id_order,
                 "id_client": db_order.id_client,
@@ -237,9 +251,8 @@ async def on_delivery_checked_message(message):
             await publish_command(message_body, routing_key)
         elif delivery['status'] == False:
             db_order = await crud.update_order_status(db, delivery['order_id'], models.Order.STATUS_CANCELED)
-            await crud.create_sagas_history(db_saga, delivery['order_id'], models.Order.STATUS_CANCELED)
+            sagas_writer.append(delivery['order_id'], models.Order.STATUS_CANCELED)
         await db.close()
-        await db_saga.close()
 
 
 async def subscribe_delivery_checked():
@@ -261,7 +274,8 @@ async def publish(message_body, routing_key):
     await exchange.publish(
         aio_pika.Message(
             body=message_body.encode(),
-            content_type="text/plain"
+            content_type="text/plain",
+            message_id=uuid.uuid4().hex
         ),
         routing_key=routing_key)
 
@@ -270,7 +284,8 @@ async def publish_command(message_body, routing_key):
     await exchange_commands.publish(
         aio_pika.Message(
             body=message_body.encode(),
-            content_type="text/plain"
+            content_type="text/plain",
+            message_id=uuid.uuid4().hex
         ),
         routing_key=routing_key)
 
@@ -278,9 +293,18 @@ async def publish_command(message_body, routing_key):
 async def on_message_delivery_cancel(message):
     async with message.process():
         delivery = json.loads(message.body)
-        db = SessionLocal()
-        db_saga = SessionLocal()
-        db_order = await crud.update_order_status(db, delivery['order_id'], models.Order.STATUS_CANCELED)
-        await crud.create_sagas_history(db_saga, delivery['order_id'], models.Order.STATUS_CANCELED)
-        await db.close()
-        await db_saga.close()
\ No newline at end of file
+        key = message_key(message, delivery['order_id'])
+        if processed_messages.seen(key):
+            logger.info("Mensaje duplicado ignorado: " + key)
+            return
+        try:
+            async with SessionLocal() as db:
+                await crud.update_order_status(db, delivery['order_id'], models.Order.STATUS_CANCELED, key)
+        except IntegrityError as exc:
+            if not is_duplicate_message(exc):
+                raise
+            logger.info("Mensaje duplicado ignorado: " + key)
+            processed_messages.remember(key)
+            return
+        processed_messages.remember(key)
+        sagas_writer.append(delivery['order_id'], models.Order.STATUS_CANCELED)
@@ -0,0 +1,5 @@
+# -*- coding: utf-8 -*-
+"""Names of the RabbitMQ exchanges, shared by the consumers and the outbox writers."""
+exchange_commands_name = 'commands'
+exchange_name = 'exchange'
+exchange_responses_name = 'responses'
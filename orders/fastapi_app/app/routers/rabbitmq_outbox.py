@@ -0,0 +1,67 @@
+import asyncio
+import os
+import logging
+import aio_pika
+from app.sql.database import SessionLocal  # pylint: disable=import-outside-toplevel
+from app.sql import crud
+from app.routers import rabbitmq
+
+# Configuración del logger
+logger = logging.getLogger(__name__)
+
+# Variables globales
+OUTBOX_BATCH_SIZE = int(os.getenv("OUTBOX_BATCH_SIZE", "100"))
+OUTBOX_POLL_INTERVAL = float(os.getenv("OUTBOX_POLL_INTERVAL", "1"))
+outbox_event = asyncio.Event()
+
+
+def notify():
+    """Wakes up the relay after new messages have been committed to the outbox."""
+    outbox_event.set()
+
+
+async def relay_outbox():
+    """
+    Vacía la tabla outbox en RabbitMQ por lotes.
+    Si un lote falla, los mensajes se quedan en la tabla y se reintentan (at-least-once).
+    """
+    while True:
+        try:
+            published = await relay_batch()
+        except Exception as e:
+            logger.error(f"Error publicando el outbox: {e}")
+            published = 0
+        if published < OUTBOX_BATCH_SIZE:
+            try:
+                await asyncio.wait_for(outbox_event.wait(), OUTBOX_POLL_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
+            outbox_event.clear()
+
+
+async def relay_batch():
+    """Publishes one batch of outbox messages and removes them once confirmed by the broker."""
+    async with SessionLocal() as db:
+        messages = await crud.get_outbox_batch(db, OUTBOX_BATCH_SIZE)
+        if not messages:
+            return 0
+        # El canal tiene publisher confirms, cada publish espera el ack del broker
+        await asyncio.gather(*(publish_outbox_message(message) for message in messages))
+        await crud.delete_outbox_messages(db, [message.id for message in messages])
+    logger.debug("%i mensajes del outbox publicados", len(messages))
+    return len(messages)
+
+
+async def publish_outbox_message(message):
+    exchanges = {
+        rabbitmq.exchange_commands_name: rabbitmq.exchange_commands,
+        rabbitmq.exchange_name: rabbitmq.exchange,
+    }
+    await exchanges[message.exchange].publish(
+        aio_pika.Message(
+            body=message.body.encode(),
+            content_type="text/plain",
+            delivery_mode=aio_pika.DeliveryMode.PERSISTENT,
+            message_id=message.message_id or f"orders-outbox-{message.id}"
+        ),
+        routing_key=message.routing_key)
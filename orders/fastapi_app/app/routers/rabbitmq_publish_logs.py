@@ -1,3 +1,4 @@
+import asyncio
 import aio_pika
 import json
 import ssl
@@ -18,6 +19,7 @@ ssl_context.verify_mode = ssl.CERT_NONE  # No verifica el certificado del servid
 channel = None
 exchange_logs_name = 'exchange'
 exchange_logs = None
+background_logs = set()
 
 async def subscribe_channel():
     """
@@ -64,4 +66,11 @@ async def publish_log(message_body, routing_key):
             body=message_body.encode(),
             content_type="text/plain"
         ),
-        routing_key=routing_key)
\ No newline at end of file
+        routing_key=routing_key)
+
+
+def publish_log_nowait(message_body, routing_key):
+    """Publish the log in the background, without making the caller wait for the broker."""
+    task = asyncio.create_task(publish_log(message_body, routing_key))
+    background_logs.add(task)
+    task.add_done_callback(background_logs.discard)
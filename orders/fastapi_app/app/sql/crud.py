@@ -2,20 +2,51 @@
 """Functions that interact with the database."""
 import logging
 import json
+import uuid
 from datetime import datetime
 from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.future import select
+from sqlalchemy.orm import noload
+from sqlalchemy.exc import IntegrityError
 from .database import SessionLocal
-from ..routers.rabbitmq import publish_command
+from ..routers.rabbitmq_exchanges import exchange_commands_name, exchange_name
 from . import models
-from sqlalchemy import update
+from ..business_logic.order_cache import order_cache
+from ..business_logic.order_events import order_events
+from sqlalchemy import update, insert, delete, inspect, text, func, case
 
 logger = logging.getLogger(__name__)
 
 
 # order functions ##################################################################################
 async def create_order_from_schema(db: AsyncSession, order):
-    """Persist a new order into the database."""
+    """Persist a new order, its sagas history and its outgoing messages in one transaction."""
+    db_order = await add_order_from_schema(db, order)
+    await db.commit()
+    return db_order
+
+
+async def create_orders_from_schemas(db: AsyncSession, orders):
+    """Persist many orders, their sagas history and their outgoing messages in one transaction."""
+    db_orders = [
+        models.Order(
+            number_of_pieces=order.number_of_pieces,
+            description=order.description,
+            status=models.Order.STATUS_PAYMENT_PENDING,
+            id_client=order.id_client
+        )
+        for order in orders
+    ]
+    db.add_all(db_orders)
+    await db.flush()  # Un solo INSERT para todos los orders
+    for db_order in db_orders:
+        add_order_side_effects(db, db_order)
+    await db.commit()
+    return db_orders
+
+
+async def add_order_from_schema(db: AsyncSession, order):
+    """Add a new order and its side effects to the session, without committing."""
     db_order = models.Order(
         number_of_pieces=order.number_of_pieces,
         description=order.description,
@@ -23,30 +54,55 @@ async def create_order_from_schema(db: AsyncSession, order):
         id_client=order.id_client
     )
     db.add(db_order)
-    await db.commit()
-    await db.refresh(db_order)
+    await db.flush()  # Obtener el id del order sin hacer commit
+    add_order_side_effects(db, db_order)
+    return db_order
+
+
+def add_order_side_effects(db: AsyncSession, db_order):
+    """Add the sagas history and outbox messages of a new order to the session."""
     # Aqui es cuando se hace el sagas
-    db_saga = SessionLocal()
-    await create_sagas_history(db_saga, db_order.id, db_order.status)
-    await db_saga.close()
+    db.add(models.SagasHistory(id_order=db_order.id, status=db_order.status))
     data = {
         "id_order": db_order.id,
         "id_client": db_order.id_client
     }
-    message_body = json.dumps(data)
-    routing_key = "delivery.check"
-    await publish_command(message_body, routing_key)
-    return db_order
+    add_outbox_message(db, exchange_commands_name, "delivery.check", json.dumps(data))
+    data = {
+        "id_order": db_order.id,
+        "id_client": db_order.id_client,
+        "movement": -(db_order.number_of_pieces)
+    }
+    add_outbox_message(db, exchange_name, "events.order.created.pending", json.dumps(data))
+    add_outbox_message(
+        db,
+        exchange_name,
+        "logs.info.order",
+        "order " + str(db_order.id) + " needs the balance to be checked"
+    )
 
 
-async def add_piece_to_order(db: AsyncSession, order):
-    """Creates piece and adds it to order."""
-    piece = models.Piece()
-    piece.order = order
-    db.add(piece)
-    await db.commit()
-    await db.refresh(order)
-    return piece
+async def insert_order_pieces(db: AsyncSession, order_id, number_of_pieces: int):
+    """Inserts the pieces of an order and adds them to its remaining pieces, without committing."""
+    if number_of_pieces <= 0:
+        return []
+    stmt = (
+        insert(models.Piece)
+        .values([
+            {"order_id": order_id, "status": models.Piece.STATUS_QUEUED}
+            for _ in range(number_of_pieces)
+        ])
+        .returning(models.Piece.id)
+    )
+    result = await db.execute(stmt)
+    piece_ids = list(result.scalars().all())
+    await db.execute(
+        update(models.Order)
+        .where(models.Order.id == order_id)
+        .values(pieces_remaining=models.Order.pieces_remaining + len(piece_ids))
+        .execution_options(synchronize_session=False)
+    )
+    return piece_ids
 
 
 async def get_order_list(db: AsyncSession):
@@ -54,6 +110,32 @@ async def get_order_list(db: AsyncSession):
     return await get_list(db, models.Order)
 
 
+def order_page_statement(after_id=None, status=None, id_client=None):
+    """Build the keyset query of orders (without pieces) ordered by id."""
+    stmt = select(models.Order).options(noload(models.Order.pieces)).order_by(models.Order.id)
+    if after_id is not None:
+        stmt = stmt.where(models.Order.id > after_id)
+    if status is not None:
+        stmt = stmt.where(models.Order.status == status)
+    if id_client is not None:
+        stmt = stmt.where(models.Order.id_client == id_client)
+    return stmt
+
+
+async def get_order_page(db: AsyncSession, limit: int, after_id=None, status=None, id_client=None):
+    """Load a page of orders placed after *after_id*."""
+    stmt = order_page_statement(after_id, status, id_client).limit(limit)
+    return await get_list_statement_result(db, stmt)
+
+
+async def stream_orders(db: AsyncSession, status=None, id_client=None, chunk_size: int = 500):
+    """Yield orders from a server-side cursor, *chunk_size* rows at a time."""
+    stmt = order_page_statement(status=status, id_client=id_client).execution_options(yield_per=chunk_size)
+    result = await db.stream(stmt)
+    async for order in result.scalars():
+        yield order
+
+
 async def get_order(db: AsyncSession, order_id):
     """Load an order from the database."""
     stmt = select(models.Order).join(models.Order.pieces).where(models.Order.id == order_id)
@@ -63,19 +145,73 @@ async def get_order(db: AsyncSession, order_id):
 
 async def delete_order(db: AsyncSession, order_id):
     """Delete order from the database."""
-    return await delete_element_by_id(db, models.Order, order_id)
+    db_order = await delete_element_by_id(db, models.Order, order_id)
+    order_cache.invalidate(order_id)
+    return db_order
 
 
-async def update_order_status(db: AsyncSession, order_id, status):
-    """Persist new order status on the database."""
+async def update_order_status(db: AsyncSession, order_id, status, message_key=None):
+    """Persist new order status on the database.
+
+    If *message_key* is given it is stored as processed in the same transaction, together
+    with any outbox message already added to the session.
+    """
     db_order = await get_element_by_id(db, models.Order, order_id)
     if db_order is not None:
         db_order.status = status
+    if message_key is not None:
+        add_processed_message(db, message_key)
+    if db_order is not None or message_key is not None:
         await db.commit()
+    if db_order is not None:
         await db.refresh(db_order)
+        order_events.publish(order_id, "status", {"id_order": order_id, "status": status})
+    order_cache.invalidate(order_id)
     return db_order
 
 
+async def update_orders_status(db: AsyncSession, order_ids, status, message_key=None):
+    """Persist the same new status for several orders with one UPDATE."""
+    await db.execute(update(models.Order).where(models.Order.id.in_(order_ids)).values(status=status))
+    if message_key is not None:
+        add_processed_message(db, message_key)
+    await db.commit()
+    for order_id in order_ids:
+        order_events.publish(order_id, "status", {"id_order": order_id, "status": status})
+        order_cache.invalidate(order_id)
+
+
+async def pay_order(db: AsyncSession, order_id, message_key=None):
+    """Marks the order as paid and creates its pieces and their events, in one transaction.
+
+    Returns (order, piece_ids); the order is None if it does not exist.
+    """
+    db_order = await get_element_by_id(db, models.Order, order_id)
+    if message_key is not None:
+        add_processed_message(db, message_key)
+    if db_order is None:
+        await db.commit()
+        return None, []
+    db_order.status = models.Order.STATUS_PAYMENT_DONE
+    piece_ids = await insert_order_pieces(db, order_id, db_order.number_of_pieces)
+    data = {
+        "id_order": db_order.id,
+        "user_id": db_order.id_client
+    }
+    add_outbox_message(db, exchange_name, "events.order.created", json.dumps(data))
+    for piece_id in piece_ids:
+        data = {
+            "piece_id": piece_id,
+            "order_id": db_order.id
+        }
+        add_outbox_message(db, exchange_name, "events.piece.created", json.dumps(data))
+    await db.commit()
+    await db.refresh(db_order)
+    order_cache.invalidate(order_id)
+    order_events.publish(order_id, "status", {"id_order": order_id, "status": db_order.status})
+    return db_order, piece_ids
+
+
 # Piece functions ##################################################################################
 async def get_piece_list_by_status(db: AsyncSession, status):
     """Get all pieces with a given status from the database."""
@@ -95,6 +231,7 @@ async def update_piece_status(db: AsyncSession, piece_id, status):
         db_piece.status = status
         await db.commit()
         await db.refresh(db_piece)
+        order_cache.invalidate(db_piece.order_id)
     return db_piece
 
 
@@ -108,6 +245,57 @@ async def update_piece_manufacturing_date_to_now(db: AsyncSession, piece_id):
     return db_piece
 
 
+async def mark_pieces_produced(db: AsyncSession, order_id, piece_ids, message_key=None):
+    """Marks the queued pieces of an order as produced with a single bulk update, and
+    decrements the order's remaining pieces counter by the number of updated pieces.
+
+    When no piece remains the same UPDATE finishes the order, and its events.order.produced
+    message goes to the outbox. Everything, including *message_key* as processed, is
+    committed in one transaction, so a redelivered message changes nothing. Returns the
+    remaining pieces of the order, or None if none of the pieces was queued.
+    """
+    result = await db.execute(
+        update(models.Piece)
+        .where(models.Piece.id.in_(piece_ids))
+        .where(models.Piece.order_id == order_id)
+        .where(models.Piece.status == models.Piece.STATUS_QUEUED)
+        .values(status=models.Piece.STATUS_CREATED)
+        .execution_options(synchronize_session=False)
+    )
+    produced = result.rowcount
+    if produced == 0:
+        await db.rollback()
+        return None
+    result = await db.execute(
+        update(models.Order)
+        .where(models.Order.id == order_id)
+        .where(models.Order.pieces_remaining > 0)
+        .values(
+            pieces_remaining=case(
+                (models.Order.pieces_remaining > produced, models.Order.pieces_remaining - produced),
+                else_=0
+            ),
+            status=case(
+                (models.Order.pieces_remaining > produced, models.Order.status),
+                else_=models.Order.STATUS_FINISHED
+            )
+        )
+        .returning(models.Order.pieces_remaining)
+        .execution_options(synchronize_session=False)
+    )
+    remaining = result.scalar()
+    if remaining == 0:
+        add_outbox_message(db, exchange_name, "events.order.produced", json.dumps({"id_order": order_id}))
+    if message_key is not None:
+        add_processed_message(db, message_key)
+    await db.commit()
+    order_cache.invalidate(order_id)
+    order_events.publish(order_id, "piece", {"id_order": order_id, "id_pieces": list(piece_ids), "pieces_remaining": remaining})
+    if remaining == 0:
+        order_events.publish(order_id, "status", {"id_order": order_id, "status": models.Order.STATUS_FINISHED})
+    return remaining
+
+
 async def get_piece_list(db: AsyncSession):
     """Load all the orders from the database."""
     stmt = select(models.Piece).join(models.Piece.order)
@@ -182,6 +370,7 @@ async def update_order(db: AsyncSession, order_id: int, update_data: dict):
         )
         result = await db.execute(stmt)
         await db.commit()
+    order_cache.invalidate(order_id)
 
     if result.rowcount == 0:
         return None  # Orden no encontrada
@@ -191,21 +380,117 @@ async def update_order(db: AsyncSession, order_id: int, update_data: dict):
 
 async def get_sagas_history_by_order_id(db: AsyncSession, id_order):
     """Load all the sagas history of certain order from the database."""
-    stmt = select(models.SagasHistory).where(models.SagasHistory.id_order == id_order)
+    stmt = (
+        select(models.SagasHistory)
+        .where(models.SagasHistory.id_order == id_order)
+        .order_by(models.SagasHistory.creation_date, models.SagasHistory.id)
+    )
     sagas = await get_list_statement_result(db, stmt)
     return sagas
 
-async def create_sagas_history(db: AsyncSession, id_order, status):
-    """Persist a new sagas history into the database."""
-    db_sagahistory = models.SagasHistory(
-        id_order=id_order,
-        status=status
-    )
-    db.add(db_sagahistory)
+async def add_sagas_history_batch(db: AsyncSession, records):
+    """Persist many sagas history records with a single multi-row insert."""
+    if not records:
+        return
+    await db.execute(insert(models.SagasHistory).values(records))
     await db.commit()
-    await db.refresh(db_sagahistory)
-    return db_sagahistory
 
 async def get_sagas_history(db: AsyncSession, id_order):
     """Load sagas history from the database."""
     return await get_sagas_history_by_order_id(db, id_order)
+
+
+# Outbox ###########################################################################################
+def add_outbox_message(db: AsyncSession, exchange, routing_key, message_body):
+    """Adds a message to the outbox. It is persisted with the caller's transaction."""
+    db_message = models.OutboxMessage(
+        exchange=exchange,
+        routing_key=routing_key,
+        body=message_body,
+        message_id=uuid.uuid4().hex
+    )
+    db.add(db_message)
+    return db_message
+
+
+async def get_outbox_batch(db: AsyncSession, limit: int):
+    """Load the oldest pending outbox messages."""
+    stmt = select(models.OutboxMessage).order_by(models.OutboxMessage.id).limit(limit)
+    return await get_list_statement_result(db, stmt)
+
+
+async def delete_outbox_messages(db: AsyncSession, message_ids):
+    """Delete already published messages from the outbox."""
+    await db.execute(
+        delete(models.OutboxMessage)
+        .where(models.OutboxMessage.id.in_(message_ids))
+        .execution_options(synchronize_session=False)
+    )
+    await db.commit()
+
+
+# Processed messages ###############################################################################
+def add_processed_message(db: AsyncSession, key):
+    """Adds a message key as processed. It is persisted with the caller's transaction, whose
+    commit fails with IntegrityError if the key was already processed."""
+    db.add(models.ProcessedMessage(key=key))
+
+
+async def delete_processed_messages_before(db: AsyncSession, before: datetime):
+    """Deletes the processed message keys created before *before*. Returns how many were deleted."""
+    result = await db.execute(
+        delete(models.ProcessedMessage)
+        .where(models.ProcessedMessage.creation_date < before)
+        .execution_options(synchronize_session=False)
+    )
+    await db.commit()
+    return result.rowcount
+
+
+# Migrations #######################################################################################
+def add_pieces_remaining_column(connection):
+    """Adds the pieces_remaining column to databases created before it existed.
+
+    Returns True if the column has been added (and therefore needs a backfill).
+    """
+    columns = [column["name"] for column in inspect(connection).get_columns("manufacturing_order")]
+    if "pieces_remaining" in columns:
+        return False
+    connection.execute(text(
+        "ALTER TABLE manufacturing_order ADD COLUMN pieces_remaining INTEGER NOT NULL DEFAULT 0"
+    ))
+    return True
+
+
+def add_outbox_message_id_column(connection):
+    """Adds the message_id column to outbox tables created before it existed."""
+    columns = [column["name"] for column in inspect(connection).get_columns("outbox")]
+    if "message_id" not in columns:
+        connection.execute(text("ALTER TABLE outbox ADD COLUMN message_id VARCHAR(64)"))
+
+
+def create_missing_indexes(connection):
+    """Creates the indexes declared in the models that are missing in existing tables.
+
+    create_all only creates the indexes of the tables it creates.
+    """
+    for table in models.Base.metadata.sorted_tables:
+        for index in table.indexes:
+            index.create(connection, checkfirst=True)
+
+
+async def backfill_pieces_remaining(db: AsyncSession):
+    """One-off backfill of pieces_remaining from the queued pieces of every order."""
+    queued_pieces = (
+        select(func.count(models.Piece.id))
+        .where(models.Piece.order_id == models.Order.id)
+        .where(models.Piece.status == models.Piece.STATUS_QUEUED)
+        .scalar_subquery()
+    )
+    result = await db.execute(
+        update(models.Order)
+        .values(pieces_remaining=queued_pieces)
+        .execution_options(synchronize_session=False)
+    )
+    await db.commit()
+    logger.info("pieces_remaining backfilled for %i orders", result.rowcount)
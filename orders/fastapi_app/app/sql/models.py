@@ -1,6 +1,6 @@
 # -*- coding: utf-8 -*-
 """Database models definitions. Table representations as class."""
-from sqlalchemy import Column, DateTime, Integer, String, TEXT, ForeignKey
+from sqlalchemy import Column, DateTime, Integer, String, TEXT, ForeignKey, Index
 from sqlalchemy.orm import relationship
 from sqlalchemy.sql import func
 from .database import Base
@@ -48,8 +48,10 @@ class Order(BaseModel):
     id = Column(Integer, primary_key=True)
     number_of_pieces = Column(Integer, nullable=False)
     description = Column(TEXT, nullable=False, default="No description")
-    status = Column(String(256), nullable=False, default=STATUS_CREATED)
-    id_client = Column(Integer, nullable=False)
+    status = Column(String(256), nullable=False, default=STATUS_CREATED, index=True)
+    id_client = Column(Integer, nullable=False, index=True)
+    # Pieces still queued; decremented atomically as piece.produced events arrive
+    pieces_remaining = Column(Integer, nullable=False, default=0, server_default="0")
     pieces = relationship("Piece", back_populates="order", lazy="joined")
 
     def as_dict(self):
@@ -99,11 +101,34 @@ class User(Base):
 class SagasHistory(BaseModel):
     """Sagas history database table representation."""
     __tablename__ = "sagas"
+    __table_args__ = (
+        Index("ix_sagas_id_order_creation_date", "id_order", "creation_date"),
+    )
     id = Column(Integer, primary_key=True)
     id_order = Column(Integer, nullable=False)
     status = Column(String(256), nullable=False)
 
 
+class OutboxMessage(BaseModel):
+    """Outbox database table representation. Messages pending to be published to RabbitMQ."""
+    __tablename__ = "outbox"
+    id = Column(Integer, primary_key=True)
+    exchange = Column(String(256), nullable=False)
+    routing_key = Column(String(256), nullable=False)
+    body = Column(TEXT, nullable=False)
+    message_id = Column(String(64), nullable=True)  # Stable across relay retries, for consumer dedup
+
+
+class ProcessedMessage(Base):
+    """Keys of the RabbitMQ messages already processed by the consumers."""
+    __tablename__ = "processed_message"
+    __table_args__ = (
+        Index("ix_processed_message_creation_date", "creation_date"),
+    )
+    key = Column(String(256), primary_key=True)
+    creation_date = Column(DateTime(timezone=True), server_default=func.now())
+
+
 class Delivery(Base):
 
     STATUS_CREATED = "CREATED"
@@ -67,6 +67,31 @@ class OrderPost(OrderBase):
     """Schema definition to create a new order."""
 
 
+class OrderBulkResult(BaseModel):
+    """Result of one of the orders of a bulk submission."""
+    index: int = Field(description="Position of the order in the request", example=0)
+    order_id: Optional[int] = Field(
+        description="Identifier of the created order. None if it has not been created.",
+        default=None,
+        example=1
+    )
+    error: Optional[str] = Field(
+        description="Reason why the order has not been created",
+        default=None,
+        example="number_of_pieces must be greater than 0"
+    )
+
+
+class OrderPage(BaseModel):
+    """Keyset paginated list of orders."""
+    orders: List[Order] = Field(description="Orders of the page, ordered by id")
+    next_after_id: Optional[int] = Field(
+        description="Value of after_id to request the next page. None if this is the last page.",
+        default=None,
+        example=50
+    )
+
+
 class PieceBase(BaseModel):
     """Piece base schema definition."""
     id: int = Field(